@@ -0,0 +1,293 @@
+"""Benchmark headless cho các đường xử lý dữ liệu của dashboard.
+
+Sinh dữ liệu tổng hợp cùng cấu trúc với ket_qua_du_bao.csv (mặc định 10.000 mã x 20 năm), rồi đo
+từng giai đoạn của risk_core: parse CSV, đọc cache cột, dựng chỉ mục, lọc, tổng hợp, tra bản ghi
+mới nhất, stress-test hàng loạt và nhận diện mã cho chatbot.
+
+    python benchmark.py                                  # 10k mã x 20 năm
+    python benchmark.py --tickers 2000 --years 10 --json ket_qua_bench.json
+    python benchmark.py --baseline ket_qua_bench.json    # thoát mã 1 nếu có giai đoạn chậm hơn ngưỡng
+    python benchmark.py --app                            # đo thêm toàn bộ app qua streamlit AppTest
+"""
+import argparse
+import itertools
+import json
+import os
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import risk_core as core
+import risk_export as export
+import risk_portfolio as portfolio
+
+SAMPLE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), core.DATA_FILE)
+GRID_ROA = np.arange(-10.0, 10.5, 1.0)   # 21 kịch bản
+GRID_DEBT = np.arange(-20.0, 20.5, 1.0)  # 41 kịch bản
+APP_PAGES = ["📊 Tổng quan & Xu hướng", "🎯 Phân tích Chiến lược", "🧭 Cẩm nang Nhà đầu tư",
+             "🔮 Trình mô phỏng Dự báo", "🤖 AI Assistant (Chatbot)"]
+
+
+# 1. SINH DỮ LIỆU TỔNG HỢP
+def _ticker_codes(n):
+    width = 3 if n <= 26 ** 3 else 4
+    return [''.join(t) for t in itertools.islice(itertools.product(string.ascii_uppercase, repeat=width), n)]
+
+
+def make_synthetic(n_tickers, n_years, seed=0, sample_csv=SAMPLE_CSV):
+    """Nhân bản cấu trúc file mẫu: mỗi mã lấy hồ sơ tài chính của một dòng mẫu, dao động ngẫu nhiên theo năm."""
+    rng = np.random.default_rng(seed)
+    sample = pd.read_csv(sample_csv, encoding='utf-8-sig')
+    sample.columns = sample.columns.str.strip()
+    n_rows = n_tickers * n_years
+
+    profile = np.repeat(rng.integers(0, len(sample), n_tickers), n_years)
+    years = np.tile(np.arange(2024 - n_years + 1, 2025), n_tickers)
+    out = {}
+    for col in sample.columns:
+        values = sample[col].to_numpy()[profile]
+        if pd.api.types.is_float_dtype(sample[col]):
+            values = values * rng.lognormal(0.0, 0.1, n_rows)
+        out[col] = values
+    df = pd.DataFrame(out)
+
+    codes = _ticker_codes(n_tickers)
+    df['ma_ck'] = np.repeat(codes, n_years)
+    df['ten_cong_ty'] = np.repeat([f"CTCP Tổng hợp {c}" for c in codes], n_years)
+    df['nganh'] = np.repeat(sample['nganh'].to_numpy()[rng.integers(0, len(sample), n_tickers)], n_years)
+    df['nam'] = years
+    df['ngay'] = [f"12/31/{y}" for y in years]
+    if 'ngay_hien_thi' in df.columns:
+        df['ngay_hien_thi'] = df['ngay']
+
+    # Điểm rủi ro: điểm hồ sơ + bước ngẫu nhiên theo năm, trạng thái suy ra từ ngưỡng XANH/VÀNG/ĐỎ
+    walk = rng.normal(0, 5, (n_tickers, n_years)).cumsum(axis=1).ravel()
+    score = np.clip(sample['diem_tin_dung'].to_numpy()[profile] + walk, 0, 100).round(2)
+    df['diem_tin_dung'] = score
+    df['xac_suat'] = score / 100
+    df['trang_thai'] = np.asarray(core.STATUS_LABELS)[core.status_codes(score)]
+    return df
+
+
+# 2. ĐO TỪNG GIAI ĐOẠN
+def measure(name, fn, repeat=1, units=None, unit_name="ops", trace_memory=True):
+    """Chạy fn `repeat` lần; trả về độ trễ (ms), thông lượng và đỉnh bộ nhớ Python (tracemalloc).
+
+    tracemalloc làm chậm đáng kể các thao tác pandas nên độ trễ đo riêng; bộ nhớ đỉnh lấy từ
+    một lần chạy thêm có bật tracemalloc (bỏ qua với các giai đoạn chỉ chạy được một lần).
+    """
+    latencies = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        latencies.append((time.perf_counter() - started) * 1000)
+    peak = None
+    if trace_memory:
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    lat = np.array(latencies)
+    per_call = units if units is not None else 1
+    return result, {
+        'stage': name,
+        'repeat': repeat,
+        'mean_ms': float(lat.mean()),
+        'p50_ms': float(np.percentile(lat, 50)),
+        'p95_ms': float(np.percentile(lat, 95)),
+        'throughput': float(per_call / (lat.mean() / 1000)) if lat.mean() > 0 else float('inf'),
+        'unit': f"{unit_name}/s",
+        'peak_mb': peak / 2 ** 20 if peak is not None else None,
+    }
+
+
+def run_benchmarks(data_dir, repeat, seed=0):
+    rng = np.random.default_rng(seed)
+    stats = []
+
+    def stage(*args, **kwargs):
+        result, record = measure(*args, **kwargs)
+        stats.append(record)
+        print(f"  {record['stage']:<28} {record['p50_ms']:>10.2f} ms", flush=True)
+        return result
+
+    csv_rows = sum(1 for _ in open(os.path.join(data_dir, core.DATA_FILE), encoding='utf-8-sig')) - 1
+    df = stage("load: parse CSV (cold)", lambda: core.load_dataset(data_dir), units=csv_rows, unit_name="rows",
+               trace_memory=False)
+    stage("load: columnar cache", lambda: core.load_dataset(data_dir), repeat=repeat, units=len(df),
+          unit_name="rows")
+
+    fidx = stage("index: filter", lambda: core.build_filter_index(df), units=len(df), unit_name="rows")
+    tidx = stage("index: ticker", lambda: core.build_ticker_index(df, fidx), units=len(df), unit_name="rows")
+
+    industries, tickers = fidx['list_nganh'], fidx['list_ma']
+    y_min, y_max = fidx['year_range']
+
+    def random_selection():
+        ind = tuple(rng.choice(industries, size=max(1, len(industries) // 4), replace=False))
+        ma = tuple(core.tickers_for_industries(fidx, ind)[:500])
+        y0 = int(rng.integers(y_min, y_max + 1))
+        return ind, ma, (y0, int(rng.integers(y0, y_max + 1)))
+
+    selections = [random_selection() for _ in range(repeat)]
+    it = iter(itertools.cycle(selections))
+    stage("filter: tickers for industries", lambda: core.tickers_for_industries(fidx, next(it)[0]),
+          repeat=repeat)
+    stage("filter: select rows", lambda: core.select_rows(fidx, *next(it)), repeat=repeat)
+
+    sel_rows = core.select_rows(fidx, *selections[0])
+    df_f = df.iloc[sel_rows]
+    stage("aggregate: overview", lambda: core.overview_aggregates(df_f), repeat=repeat, units=len(df_f),
+          unit_name="rows")
+    stage("aggregate: strategy", lambda: core.strategy_aggregates(df_f), repeat=repeat, units=len(df_f),
+          unit_name="rows")
+
+    probes = [str(m) for m in rng.choice(tickers, size=1000)]
+    stage("lookup: latest record x1000",
+          lambda: [core.latest_record(df, fidx, tidx, m, (y_min, y_max)) for m in probes],
+          repeat=max(1, repeat // 5), units=len(probes), unit_name="lookups")
+    stage("lookup: history x1000", lambda: [core.ticker_history(df, fidx, tidx, m) for m in probes],
+          repeat=max(1, repeat // 5), units=len(probes), unit_name="lookups")
+
+    pos = core.latest_positions(fidx, tidx, (y_min, y_max))
+    pos = pos[pos >= 0]
+    base = df['Điểm rủi ro'].to_numpy(dtype='float64')[pos]
+    n_scen = len(GRID_ROA) * len(GRID_DEBT)
+    stage("stress: linear grid", lambda: core.stress_scores(base, GRID_ROA, GRID_DEBT), repeat=repeat,
+          units=len(base) * n_scen, unit_name="scores")
+    scores = core.stress_scores(base, GRID_ROA, GRID_DEBT)
+    stage("stress: transitions", lambda: core.status_transitions(base, scores), repeat=repeat,
+          units=len(base) * n_scen, unit_name="scores")
+    engine = stage("stress: fit scoring engine", lambda: core.build_scoring_engine(df), units=len(df),
+                   unit_name="rows")
+    if engine is not None:
+        stage("stress: model 1 ticker", lambda: core.model_stress_scores(engine, pos[:1], [5.0], [-3.0]),
+              repeat=repeat * 10)
+        stage("stress: model grid (all)", lambda: core.model_stress_scores(engine, pos, GRID_ROA, GRID_DEBT),
+              repeat=max(1, repeat // 10), units=len(pos) * n_scen, unit_name="scores")
+
+    alerts = stage("alerts: build (all rows)", lambda: core.build_alerts(df, fidx, tidx), units=len(df),
+                   unit_name="rows")
+    stage("alerts: rows in selection", lambda: core.alert_rows(alerts, core.select_rows(fidx, *next(it))),
+          repeat=repeat)
+
+    peer_index = stage("peers: build index", lambda: core.build_peer_index(df, fidx), units=len(df),
+                       unit_name="rows")
+    queries = rng.integers(0, len(df), size=100)
+    stage("peers: top-5 cosine x100", lambda: [core.find_peers(peer_index, q, 5) for q in queries],
+          repeat=max(1, repeat // 5), units=len(queries), unit_name="queries")
+    stage("peers: top-5 euclid same year x100",
+          lambda: [core.find_peers(peer_index, q, 5, 'euclidean', same_year=True) for q in queries],
+          repeat=max(1, repeat // 5), units=len(queries), unit_name="queries")
+
+    for fmt in export.available_formats():
+        stage(f"export: {fmt} (selection)", lambda: export.export_file(export.iter_chunks(df, sel_rows), fmt),
+              repeat=max(1, repeat // 5), units=len(sel_rows), unit_name="rows")
+    alerts = core.build_alerts(df, fidx, tidx)
+    with ThreadPoolExecutor(export.REPORT_WORKERS) as pool:
+        fig_cache = export.FigureCache()
+        report_rows = core.select_rows(fidx, tuple(industries), tuple(tickers[:40]), (y_min, y_max))
+        stage("report: 40 tickers (cold)", lambda: export.render_report(
+            df, fidx, tidx, report_rows, pool, fig_cache, (y_min, y_max), alerts), units=40, unit_name="tickers")
+        stage("report: 40 tickers (warm)", lambda: export.render_report(
+            df, fidx, tidx, report_rows, pool, fig_cache, (y_min, y_max), alerts), units=40, unit_name="tickers")
+
+    book = pd.DataFrame({'ma_ck': rng.choice(tickers, size=min(500, len(tickers)), replace=False),
+                         'ty_trong': rng.random(min(500, len(tickers)))}).to_csv(index=False).encode()
+    holdings = stage("portfolio: parse 500 names", lambda: portfolio.parse_holdings(book), repeat=repeat)
+    stage("portfolio: metrics 500 names", lambda: portfolio.portfolio_metrics(
+        df, fidx, tidx, holdings, next(it)[2]), repeat=repeat, units=len(holdings), unit_name="names")
+
+    matcher = stage("chatbot: build matcher", lambda: core.build_ticker_matcher(df), units=len(tickers),
+                    unit_name="tickers")
+    messages = [f"So sánh {a} với {b} và công ty Tổng hợp {c} thế nào?"
+                for a, b, c in rng.choice(tickers, size=(200, 3))]
+    stage("chatbot: match x200", lambda: [core.match_tickers(matcher, m) for m in messages], repeat=repeat,
+          units=len(messages), unit_name="messages")
+    return stats
+
+
+def run_app_benchmark(data_dir, repeat):
+    """Đo độ trễ rerun của toàn bộ app (mỗi trang) trên dữ liệu tổng hợp qua streamlit AppTest."""
+    from streamlit.testing.v1 import AppTest
+
+    os.environ['RISK_DATA_DIR'] = data_dir
+    app = AppTest.from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "code_app.py"),
+                            default_timeout=600)
+    stats = []
+    _, record = measure("app: first run", app.run, trace_memory=False)
+    stats.append(record)
+    for page in APP_PAGES:
+        app.sidebar.radio[0].set_value(page)
+        _, record = measure(f"app: {page}", app.run, repeat=repeat, trace_memory=False)
+        if app.exception:
+            raise RuntimeError(f"{page}: {app.exception[0].message}")
+        stats.append(record)
+    return stats
+
+
+# 3. BÁO CÁO VÀ SO SÁNH VỚI MỐC
+def print_report(stats):
+    print(f"\n{'Giai đoạn':<34}{'n':>5}{'p50 ms':>11}{'p95 ms':>11}{'thông lượng':>22}{'peak MB':>10}")
+    for s in stats:
+        print(f"{s['stage']:<34}{s['repeat']:>5}{s['p50_ms']:>11.2f}{s['p95_ms']:>11.2f}"
+              f"{s['throughput']:>14,.0f} {s['unit']:<10}"
+              f"{'-' if s['peak_mb'] is None else format(s['peak_mb'], '.1f'):>7}")
+
+
+def compare_baseline(stats, baseline_path, tolerance):
+    """Các giai đoạn có p50 chậm hơn mốc quá `tolerance` (tỷ lệ)."""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {s['stage']: s for s in json.load(f)['stages']}
+    regressions = []
+    for s in stats:
+        ref = baseline.get(s['stage'])
+        if ref and ref['p50_ms'] > 0 and s['p50_ms'] > ref['p50_ms'] * (1 + tolerance):
+            regressions.append((s['stage'], ref['p50_ms'], s['p50_ms']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tickers', type=int, default=10_000)
+    parser.add_argument('--years', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20, help="số lần lặp cho các giai đoạn nhanh")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--app', action='store_true', help="đo thêm toàn bộ app qua streamlit AppTest")
+    parser.add_argument('--json', help="ghi kết quả ra file JSON (dùng làm mốc cho lần sau)")
+    parser.add_argument('--baseline', help="file JSON mốc để phát hiện chậm đi")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="mức chậm hơn mốc cho phép (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        print(f"Sinh dữ liệu tổng hợp {args.tickers:,} mã x {args.years} năm...", flush=True)
+        make_synthetic(args.tickers, args.years, seed=args.seed).to_csv(
+            os.path.join(data_dir, core.DATA_FILE), index=False, encoding='utf-8-sig')
+        stats = run_benchmarks(data_dir, args.repeat, seed=args.seed)
+        if args.app:
+            stats += run_app_benchmark(data_dir, max(1, args.repeat // 5))
+
+    print_report(stats)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'tickers': args.tickers, 'years': args.years, 'stages': stats}, f, ensure_ascii=False,
+                      indent=2)
+    if args.baseline:
+        regressions = compare_baseline(stats, args.baseline, args.tolerance)
+        for name, ref, now in regressions:
+            print(f"❌ Chậm hơn mốc: {name}: {ref:.2f} ms -> {now:.2f} ms")
+        if regressions:
+            return 1
+        print("✅ Không có giai đoạn nào chậm hơn mốc.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
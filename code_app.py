@@ -1,9 +1,25 @@
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+import functools
+import json
 import os
+import sys
+import threading
 import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+import risk_core as core
+import risk_export as export
+import risk_portfolio as portfolio
+from risk_core import (ALERT_RULES, STATUS_BINS, STATUS_LABELS, alert_labels, alert_rows, compact_chat,
+                       data_signature, find_peers, latest_positions, latest_record, load_dataset, match_tickers,
+                       model_stress_scores, radar_scores, selection_stamp, status_codes, status_transitions,
+                       stress_scores, ticker_history, tickers_in_rows)
 
 # 1. CẤU HÌNH TRANG
 st.set_page_config(page_title="Hệ thống Cảnh báo Rủi ro Tài chính", layout="wide")
@@ -53,71 +69,395 @@ st.markdown("""
     """, unsafe_allow_html=True)
 
 
-# 2. HÀM LOAD DATA
-@st.cache_data
-def load_data():
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    # LƯU Ý: Đảm bảo tên file CSV khớp với file bạn đã xuất ra
-    file_name = "ket_qua_du_bao.csv"
-    file_path = os.path.join(current_dir, file_name)
+# 2. ĐO HIỆU NĂNG (chỉ bật phía server bằng biến môi trường RISK_DIAGNOSTICS=1; người xem không tự bật được)
+PERF_ENABLED = os.environ.get('RISK_DIAGNOSTICS') == '1'
+PERF_HISTORY = 200  # Số lần rerun gần nhất giữ lại để tính p50/p95
+PERF_LOG_FILE = os.environ.get('RISK_DIAGNOSTICS_LOG',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "perf_log.jsonl"))
+PERF_LOG_MAX_BYTES = 5 * 1024 * 1024  # Log vượt cỡ này thì xoay vòng sang perf_log.jsonl.1 (chỉ giữ 1 bản cũ)
+DIAG_PAGE = "⚙️ Diagnostics"
+SESSION_TTL_S = 3600  # Phiên không rerun quá lâu thì bỏ khỏi bảng thống kê bộ nhớ
+
+
+@st.cache_resource
+def _perf_store():
+    """Bộ đếm dùng chung cho cả tiến trình (mọi phiên)."""
+    return {'lock': threading.Lock(), 'runs': deque(maxlen=PERF_HISTORY), 'calls': Counter(), 'misses': Counter(),
+            'sessions': {}}
+
+
+def _rss_mb():
     try:
-        if os.path.exists(file_path):
-            df = pd.read_csv(file_path, encoding='utf-8-sig')
-            df.columns = df.columns.str.strip()
-            if 'ten_cong_ty' in df.columns:
-                df.loc[df['ma_ck'] == 'VNM', 'ten_cong_ty'] = 'CTCP Sữa Việt Nam (Vinamilk)'
-            mapping = {
-                'ma_ck': 'Mã doanh nghiệp', 'ten_cong_ty': 'Tên công ty',
-                'nganh': 'Ngành nghề', 'ngay': 'Ngày báo cáo',
-                'diem_tin_dung': 'Điểm rủi ro', 'trang_thai': 'Trạng thái'
-            }
-            df = df.rename(columns=mapping)
-            if 'Ngày báo cáo' in df.columns:
-                df['Ngày báo cáo'] = pd.to_datetime(df['Ngày báo cáo'], errors='coerce')
-                df['Năm'] = df['Ngày báo cáo'].dt.year
-            return df
-        return pd.DataFrame()
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return float('nan')
+
+
+def _deep_size(obj, seen=None):
+    """Ước lượng số byte của một giá trị trong session_state (đi sâu vào list/dict, DataFrame, mảng numpy)."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    return size
+
+
+def _session_usage():
+    """Bộ nhớ riêng của phiên hiện tại (chỉ session_state; dữ liệu và cache dùng chung không tính)."""
+    ctx = get_script_run_ctx()
+    state = st.session_state.to_dict()
+    return (ctx.session_id if ctx else 'bare'), {
+        'ts': time.time(), 'state_kb': _deep_size(state) / 1024, 'keys': len(state),
+        'messages': len(state.get('messages', [])),
+    }
+
+
+# Trạng thái đo của lần rerun hiện tại (script chạy lại từ đầu ở mỗi rerun nên biến này luôn mới)
+_perf_run = {'stages': {}, 'rss_mb': {}, 'current': None}
+
+
+def perf_mark(stage=None):
+    """Kết thúc giai đoạn đang đo (nếu có) và bắt đầu đo giai đoạn `stage`."""
+    if not PERF_ENABLED:
+        return
+    now = time.perf_counter()
+    if _perf_run['current'] is not None:
+        name, started = _perf_run['current']
+        _perf_run['stages'][name] = _perf_run['stages'].get(name, 0.0) + (now - started) * 1000
+        _perf_run['rss_mb'][name] = _rss_mb()
+    _perf_run['current'] = (stage, now) if stage else None
+
+
+def perf_finish_run():
+    """Chốt số liệu của lần rerun: lưu vào bộ nhớ chung và ghi thêm một dòng vào log JSONL."""
+    if not PERF_ENABLED:
+        return
+    perf_mark(None)
+    session_id, usage = _session_usage()
+    record = {'ts': time.time(), 'release': os.environ.get('APP_RELEASE', ''),
+              'stages_ms': _perf_run['stages'], 'rss_mb': _perf_run['rss_mb'], 'session_kb': usage['state_kb']}
+    store = _perf_store()
+    with store['lock']:
+        store['runs'].append(record)
+        store['sessions'][session_id] = usage
+        for sid in [k for k, v in store['sessions'].items() if record['ts'] - v['ts'] > SESSION_TTL_S]:
+            del store['sessions'][sid]
+    try:
+        os.makedirs(os.path.dirname(PERF_LOG_FILE), exist_ok=True)
+        if os.path.exists(PERF_LOG_FILE) and os.path.getsize(PERF_LOG_FILE) > PERF_LOG_MAX_BYTES:
+            os.replace(PERF_LOG_FILE, PERF_LOG_FILE + ".1")
+        with open(PERF_LOG_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError:
+        pass
+
+
+def perf_cached(cache_decorator, **cache_kwargs):
+    """Giống @st.cache_data / @st.cache_resource nhưng đếm số lần gọi và số lần phải tính lại (miss)."""
+    def decorate(fn):
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        def compute(*args, **kwargs):
+            store = _perf_store()
+            with store['lock']:
+                store['misses'][name] += 1
+            return fn(*args, **kwargs)
+
+        cached = cache_decorator(**cache_kwargs)(compute)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            store = _perf_store()
+            with store['lock']:
+                store['calls'][name] += 1
+            return cached(*args, **kwargs)
+
+        call.clear = cached.clear
+        return call
+    return decorate
+
+
+# 3. HÀM LOAD DATA
+# cache_resource: một DataFrame duy nhất cho cả tiến trình, mọi phiên chỉ đọc và lấy dòng theo vị trí
+# (cache_data trả về một bản sao mới ở mỗi lần gọi -> bộ nhớ tăng theo số phiên đang chạy)
+@perf_cached(st.cache_resource, max_entries=2)
+def load_data(base_dir, signature=()):
+    """`signature` (từ data_signature) chỉ dùng làm khóa cache: đổi khi CSV gốc hoặc thư mục kỳ mới thay đổi."""
+    try:
+        return load_dataset(base_dir)
     except Exception as e:
         st.error(f"❌ Lỗi: {e}")
         return pd.DataFrame()
 
 
-df = load_data()
+perf_mark("load_data")
+data_dir = core.data_dir()
+df = load_data(data_dir, data_signature(data_dir))
+
+
+# 4. CHỈ MỤC BỘ LỌC (dựng một lần cho mỗi phiên bản dữ liệu, dùng chung giữa các phiên)
+@perf_cached(st.cache_resource, max_entries=4)
+def build_filter_index(_df, data_version):
+    return core.build_filter_index(_df)
+
+
+@perf_cached(st.cache_data, max_entries=256)
+def tickers_for_industries(_fidx, data_version, sel_ind):
+    return core.tickers_for_industries(_fidx, sel_ind)
+
+
+@perf_cached(st.cache_data, max_entries=256)
+def select_rows(_fidx, data_version, sel_ind, sel_ma, year_range):
+    return core.select_rows(_fidx, sel_ind, sel_ma, year_range)
+
+
+@perf_cached(st.cache_resource, max_entries=4)
+def build_ticker_index(_df, _fidx, data_version):
+    return core.build_ticker_index(_df, _fidx)
+
+
+# 5. TẦNG TỔNG HỢP (dùng chung giữa các phiên, khóa theo trạng thái bộ lọc)
+AGG_CACHE_ENTRIES = 64
+
+
+@perf_cached(st.cache_data, max_entries=AGG_CACHE_ENTRIES)
+def overview_aggregates(_df, _rows, data_stamp, sel_ind, sel_ma, year_range):
+    return core.overview_aggregates(_df.iloc[_rows])
+
+
+@perf_cached(st.cache_data, max_entries=AGG_CACHE_ENTRIES)
+def strategy_aggregates(_df, _rows, data_stamp, sel_ind, sel_ma, year_range):
+    return core.strategy_aggregates(_df.iloc[_rows])
+
+
+# --- Biểu đồ dựng sẵn theo trạng thái bộ lọc (dùng chung giữa các phiên) ---
+FIG_CACHE_ENTRIES = 32
+LARGE_SELECTION_TICKERS = 30  # Vượt ngưỡng này: chuyển sang WebGL + giới hạn số đường
+TOP_N_TRACES = 15
+HEATMAP_PAGE_ROWS = 40
+
+
+@perf_cached(st.cache_resource, max_entries=FIG_CACHE_ENTRIES)
+def trend_figure(_df, _rows, data_stamp, sel_ind, sel_ma, year_range):
+    """Biểu đồ đường điểm rủi ro; danh mục lớn chỉ vẽ Top-N rủi ro (Scattergl) + dải trung vị P25-P75."""
+    title = "Biến động điểm rủi ro qua các kỳ báo cáo"
+    df_f = _df.iloc[_rows]  # chỉ cắt dữ liệu khi cache chưa có biểu đồ
+    tickers = df_f['Mã doanh nghiệp'].nunique()
+    if tickers <= LARGE_SELECTION_TICKERS:
+        return px.line(df_f, x="Năm", y='Điểm rủi ro', color='Mã doanh nghiệp', markers=True,
+                       title=title, template="plotly_white")
+
+    band = df_f.groupby('Năm')['Điểm rủi ro'].quantile([0.25, 0.5, 0.75]).unstack()
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=band.index, y=band[0.75], mode='lines', line=dict(width=0),
+                             showlegend=False, hoverinfo='skip'))
+    fig.add_trace(go.Scatter(x=band.index, y=band[0.25], mode='lines', line=dict(width=0), fill='tonexty',
+                             fillcolor='rgba(127, 140, 141, 0.25)', name='P25 - P75'))
+    fig.add_trace(go.Scatter(x=band.index, y=band[0.5], mode='lines', name='Trung vị',
+                             line=dict(color='#7f8c8d', dash='dash', width=3)))
+
+    top = df_f.groupby('Mã doanh nghiệp', observed=True)['Điểm rủi ro'].mean().nlargest(TOP_N_TRACES).index
+    top_rows = df_f[df_f['Mã doanh nghiệp'].isin(top)].sort_values(['Mã doanh nghiệp', 'Năm'])
+    for ma, g in top_rows.groupby('Mã doanh nghiệp', observed=True):
+        fig.add_trace(go.Scattergl(x=g['Năm'], y=g['Điểm rủi ro'], mode='lines+markers', name=str(ma)))
+    fig.update_layout(title=f"{title} (Top {len(top)}/{tickers} mã rủi ro cao nhất + dải trung vị)",
+                      template="plotly_white", xaxis_title="Năm", yaxis_title='Điểm rủi ro')
+    return fig
+
+
+@perf_cached(st.cache_resource, max_entries=FIG_CACHE_ENTRIES)
+def heatmap_figure(_heatmap_data, data_stamp, sel_ind, sel_ma, year_range, page):
+    """Heatmap Mã x Năm, mỗi trang tối đa HEATMAP_PAGE_ROWS mã."""
+    rows = _heatmap_data.iloc[page * HEATMAP_PAGE_ROWS:(page + 1) * HEATMAP_PAGE_ROWS]
+    fig = px.imshow(rows, text_auto=".1f", color_continuous_scale='RdYlGn_r', aspect='auto')
+    fig.update_layout(height=max(300, 22 * len(rows) + 120))
+    return fig
+
+
+@perf_cached(st.cache_resource, max_entries=FIG_CACHE_ENTRIES)
+def sunburst_figure(_df, _rows, data_stamp, sel_ind, sel_ma, year_range):
+    """Sunburst Ngành > Mã dựng từ bảng đã gộp theo mã thay vì nhúng từng dòng dữ liệu."""
+    df_f = _df.iloc[_rows]
+    score = df_f['Điểm rủi ro']
+    agg = (df_f.assign(_sq=score * score)
+           .groupby(['Ngành nghề', 'Mã doanh nghiệp'], observed=True)
+           .agg(**{'Điểm rủi ro': ('Điểm rủi ro', 'sum'), '_sq': ('_sq', 'sum')}).reset_index())
+    # Màu = trung bình có trọng số theo điểm (đúng như px.sunburst tính trên dữ liệu gốc)
+    agg['Màu'] = (agg['_sq'] / agg['Điểm rủi ro'].where(agg['Điểm rủi ro'] != 0)).fillna(0)
+    return px.sunburst(agg, path=['Ngành nghề', 'Mã doanh nghiệp'], values='Điểm rủi ro', color='Màu',
+                       color_continuous_scale='RdYlGn_r', labels={'Màu': 'Điểm rủi ro'})
+
+
+# 6. MÔ PHỎNG STRESS-TEST
+@perf_cached(st.cache_resource, max_entries=4)
+def build_scoring_engine(_df, data_version):
+    return core.build_scoring_engine(_df)
+
+
+# Lưới kịch bản hàng loạt: mảng [mã x ROA x Nợ] có thể tới vài chục MB -> cache_resource (chỉ đọc, không sao chép
+# ở mỗi lần trúng như cache_data); thanh trượt kịch bản chi tiết chỉ cắt [:, i_roa, i_debt] từ kết quả này
+@perf_cached(st.cache_resource, max_entries=4)
+def batch_stress(_df, _fidx, _tidx, _engine, data_version, scope_ma, year_range, roa_range, debt_range, use_model):
+    step = core.MODEL_SHOCK_STEP if use_model else 1.0
+    roa_grid = np.arange(roa_range[0], roa_range[1] + step / 2, step)
+    debt_grid = np.arange(debt_range[0], debt_range[1] + step / 2, step)
+    codes = np.arange(len(_fidx['ma_pos'])) if scope_ma is None else \
+        np.array([_fidx['ma_pos'][m] for m in scope_ma], dtype=np.int64)
+    pos = latest_positions(_fidx, _tidx, year_range)[codes]
+    codes, pos = codes[pos >= 0], pos[pos >= 0]
+    base = _df['Điểm rủi ro'].to_numpy(dtype='float64')[pos]
+    scores = model_stress_scores(_engine, pos, roa_grid, debt_grid) if use_model else \
+        stress_scores(base, roa_grid, debt_grid)
+    return {'roa_grid': roa_grid, 'debt_grid': debt_grid, 'codes': codes, 'base': base, 'scores': scores,
+            'red_counts': (status_codes(scores) == 2).sum(axis=0),
+            'transitions': status_transitions(base, scores)}
+
+
+# 7. NHẬN DIỆN MÃ / TÊN CÔNG TY CHO CHATBOT
+@perf_cached(st.cache_resource, max_entries=4)
+def build_ticker_matcher(_df, data_version):
+    return core.build_ticker_matcher(_df)
+
+
+# 8. CẢNH BÁO SỚM (quét toàn bộ một lần cho mỗi phiên bản dữ liệu + bộ ngưỡng)
+@perf_cached(st.cache_resource, max_entries=8)
+def build_alerts(_df, _fidx, _tidx, data_version, rules):
+    return core.build_alerts(_df, _fidx, _tidx, **dict(rules))
+
+
+# 9. TÌM DOANH NGHIỆP TƯƠNG ĐỒNG (ma trận tỷ số chuẩn hóa dựng một lần, truy vấn top-k vài ms)
+@perf_cached(st.cache_resource, max_entries=4)
+def build_peer_index(_df, _fidx, data_version):
+    return core.build_peer_index(_df, _fidx)
+
+
+# 10. XUẤT FILE VÀ BÁO CÁO (pool luồng + cache biểu đồ theo mã x năm, dùng chung cho cả tiến trình)
+EXPORT_PAGE = "📤 Xuất báo cáo"
+REPORT_JOB_HISTORY = 8  # Số báo cáo gần nhất giữ lại để phiên khác (cùng bộ lọc) tải ngay
+
+
+@st.cache_resource
+def _report_workers():
+    return {'render': ThreadPoolExecutor(export.REPORT_WORKERS, thread_name_prefix='report-fig'),
+            'jobs': ThreadPoolExecutor(2, thread_name_prefix='report-job'),
+            'figures': export.FigureCache(), 'lock': threading.Lock(), 'done': {}}
+
 
-# 3. GIAO DIỆN VÀ BỘ LỌC
+def submit_report(job_key, *args, **kwargs):
+    """Đưa việc dựng báo cáo vào nền; cùng job_key (bộ lọc + ngưỡng) thì dùng lại việc đang chạy/đã xong.
+
+    Việc đã lỗi không được dùng lại: gọi lại sẽ dựng mới (nút "Thử lại").
+    """
+    workers = _report_workers()
+    with workers['lock']:
+        job = workers['done'].get(job_key)
+        if job is None or (job.done() and job.exception() is not None):
+            workers['done'].pop(job_key, None)
+            workers['done'][job_key] = workers['jobs'].submit(export.render_report, *args, pool=workers['render'],
+                                                              fig_cache=workers['figures'], **kwargs)
+            while len(workers['done']) > REPORT_JOB_HISTORY:
+                workers['done'].pop(next(iter(workers['done'])))
+        return workers['done'][job_key]
+
+
+def report_job(job_key):
+    with _report_workers()['lock']:
+        return _report_workers()['done'].get(job_key)
+
+
+@st.fragment(run_every=1.0)
+def wait_for_report(job):
+    """Chỉ chạy lại khối nhỏ này mỗi giây trong lúc chờ; xong thì rerun cả trang để hiện nút tải."""
+    if job.done():
+        st.rerun()
+    st.info("⏳ Đang dựng báo cáo trong nền, bạn có thể chuyển trang và quay lại sau...")
+
+
+# 11. DANH MỤC ĐẦU TƯ (khóa cache theo nội dung file danh mục + phiên bản dữ liệu + giai đoạn)
+PORTFOLIO_PAGE = "💼 Danh mục đầu tư"
+
+
+@perf_cached(st.cache_data, max_entries=16)
+def parse_holdings(_raw, holdings_key, file_name):
+    return portfolio.parse_holdings(_raw, file_name)
+
+
+@perf_cached(st.cache_data, max_entries=AGG_CACHE_ENTRIES)
+def portfolio_metrics(_df, _fidx, _tidx, _holdings, holdings_key, data_version, year_range, window):
+    return portfolio.portfolio_metrics(_df, _fidx, _tidx, _holdings, year_range, window)
+
+
+# 12. GIAO DIỆN VÀ BỘ LỌC
 if not df.empty:
     st.sidebar.title("🛡️ RISK MGMT PRO")
+    for name, reason in df.attrs.get('rejected', []):
+        st.sidebar.warning(f"⚠️ Bỏ qua file kỳ mới '{name}': {reason}")
     menu = st.sidebar.radio("Chọn chức năng:", [
         "📊 Tổng quan & Xu hướng",
         "🎯 Phân tích Chiến lược",
         "🧭 Cẩm nang Nhà đầu tư",
         "🔮 Trình mô phỏng Dự báo",
-        "🤖 AI Assistant (Chatbot)"
-    ])
+        "🤖 AI Assistant (Chatbot)",
+        EXPORT_PAGE,
+        PORTFOLIO_PAGE
+    ] + ([DIAG_PAGE] if PERF_ENABLED else []))
 
     st.sidebar.markdown("---")
     col_nganh = 'Ngành nghề';
     col_ma = 'Mã doanh nghiệp';
     col_diem = 'Điểm rủi ro'
 
+    perf_mark("indexes")
+    data_version = df.attrs.get('data_version')
+    fidx = build_filter_index(df, data_version)
+    tidx = build_ticker_index(df, fidx, data_version)
+    engine = build_scoring_engine(df, data_version)
+    matcher = build_ticker_matcher(df, data_version)
+    peer_index = build_peer_index(df, fidx, data_version)
+
+    # --- NGƯỠNG CẢNH BÁO (dùng chung cho banner, KPI, Cẩm nang và chatbot) ---
+    with st.sidebar.expander("🚨 Ngưỡng cảnh báo"):
+        rules = (
+            ('score_threshold', st.number_input("Điểm rủi ro ≥", 0.0, 100.0, ALERT_RULES['score_threshold'], 5.0)),
+            ('jump_threshold', st.number_input("Điểm tăng so với kỳ trước ≥", 0.0, 100.0,
+                                               ALERT_RULES['jump_threshold'], 5.0)),
+            ('ratio_worsen_pct', st.number_input("Tỷ số xấu đi ≥ (%)", 0.0, 500.0,
+                                                 ALERT_RULES['ratio_worsen_pct'], 5.0)),
+            ('min_ratio_signals', st.number_input("Số tỷ số xấu đi tối thiểu", 1, len(core.ALERT_RATIOS),
+                                                  ALERT_RULES['min_ratio_signals'])),
+        )
+    alerts = build_alerts(df, fidx, tidx, data_version, rules)
+
     # --- BỘ LỌC NGÀNH ---
-    list_nganh = sorted(df[col_nganh].unique().astype(str))
+    perf_mark("filters")
+    list_nganh = fidx['list_nganh']
     sel_ind = st.sidebar.multiselect("Ngành nghề:", list_nganh, default=list_nganh)
-    df_f = df[df[col_nganh].isin(sel_ind)]
 
     # --- BỘ LỌC MÃ CHỨNG KHOÁN ---
-    full_list_ma = sorted(df[col_ma].unique().astype(str))
-    list_ma_f = sorted(df_f[col_ma].unique().astype(str))
+    full_list_ma = fidx['list_ma']
+    list_ma_f = tickers_for_industries(fidx, data_version, tuple(sel_ind))
 
     # Mặc định chọn 5 mã đầu tiên để hiển thị cho đỡ rối
     default_ma = list_ma_f[:5] if len(list_ma_f) >= 5 else list_ma_f
     sel_ma = st.sidebar.multiselect("Mã chứng khoán:", list_ma_f, default=default_ma)
-    df_f = df_f[df_f[col_ma].isin(sel_ma)]
 
     # === [MỚI] BỘ LỌC THỜI GIAN (NĂM) ===
-    if 'Năm' in df.columns and not df['Năm'].isnull().all():
-        min_year = int(df['Năm'].min())
-        max_year = int(df['Năm'].max())
+    selected_years = None
+    if fidx['year_range'] is not None:
+        min_year, max_year = fidx['year_range']
 
         st.sidebar.markdown("---")
         selected_years = st.sidebar.slider(
@@ -126,65 +466,73 @@ if not df.empty:
             max_value=max_year,
             value=(min_year, max_year)  # Mặc định chọn từ đầu đến cuối
         )
-
-        # Áp dụng lọc thời gian vào df_f
-        df_f = df_f[
-            (df_f['Năm'] >= selected_years[0]) &
-            (df_f['Năm'] <= selected_years[1])
-            ]
     # ====================================
 
+    # Áp dụng cả 3 bộ lọc trong một lần lấy dòng (thay vì 3 bản sao liên tiếp)
+    # Phiên chỉ giữ vị trí dòng; dữ liệu dùng chung chỉ bị cắt trong hàm cache khi thật sự cần tính lại
+    rows = select_rows(fidx, data_version, tuple(sel_ind), tuple(sel_ma), selected_years)
+    # Khóa cache tổng hợp/biểu đồ: chỉ đổi khi dữ liệu của chính các mã đang chọn đổi
+    filter_key = (selection_stamp(df, sel_ma), tuple(sel_ind), tuple(sel_ma), selected_years)
+
     # --- TICKER (Dựa trên dữ liệu sau khi lọc) ---
-    danger_list = df_f[df_f[col_diem] > 70][col_ma].unique()
-    ticker_text = "  |  ".join([f"🔴 CẢNH BÁO: {m}" for m in danger_list]) if len(
-        danger_list) > 0 else "🟢 DANH MỤC ĐANG THEO DÕI ỔN ĐỊNH"
+    # Đọc cờ từ bảng cảnh báo đã tính sẵn thay vì quét lại dữ liệu đã lọc
+    ma_categories = fidx['ma_categories']
+    danger_codes = np.unique(fidx['ma_codes'][alert_rows(alerts, rows)])
+    watch_codes = np.setdiff1d(fidx['ma_codes'][alert_rows(alerts, rows, ('jump', 'downgrade'))], danger_codes)
+    ticker_items = ([f"🔴 CẢNH BÁO: {ma_categories[c]}" for c in danger_codes] +
+                    [f"🟠 XẤU ĐI: {ma_categories[c]}" for c in watch_codes])
+    ticker_text = "  |  ".join(ticker_items) if ticker_items else "🟢 DANH MỤC ĐANG THEO DÕI ỔN ĐỊNH"
     st.markdown(f'<div class="ticker-wrap"><div class="ticker">{ticker_text}</div></div>', unsafe_allow_html=True)
 
     # --- TRANG 1: TỔNG QUAN ---
+    perf_mark(f"page:{menu}")
     if menu == "📊 Tổng quan & Xu hướng":
         st.markdown(
             '<div class="main-title">PHÂN TÍCH VÀ ỨNG DỤNG HỌC MÁY TRONG CẢNH BÁO SỚM RỦI RO TÀI CHÍNH<br><span style="font-size:0.6em; color:#555;">CÁC DOANH NGHIỆP PHI TÀI CHÍNH NIÊM YẾT TẠI VIỆT NAM</span></div>',
             unsafe_allow_html=True)
 
-        if df_f.empty:
+        if len(rows) == 0:
             st.warning("⚠️ Không có dữ liệu trong khoảng thời gian hoặc mã chứng khoán bạn chọn.")
         else:
             # Biểu đồ Line
-            st.plotly_chart(px.line(df_f, x="Năm", y=col_diem, color=col_ma, markers=True,
-                                    title="Biến động điểm rủi ro qua các kỳ báo cáo", template="plotly_white"),
-                            use_container_width=True)
+            st.plotly_chart(trend_figure(df, rows, *filter_key), use_container_width=True)
 
             # Heatmap
             st.markdown("### 🌡️ Heatmap Rủi ro Doanh nghiệp (Đỏ: Cao - Xanh: Thấp)")
-            heatmap_data = df_f.pivot_table(index=col_ma, columns='Năm', values=col_diem, aggfunc='mean')
+            heatmap_data = overview_aggregates(df, rows, *filter_key)
             if not heatmap_data.empty:
-                st.plotly_chart(px.imshow(heatmap_data, text_auto=".1f", color_continuous_scale='RdYlGn_r'),
-                                use_container_width=True)
+                n_pages = -(-len(heatmap_data) // HEATMAP_PAGE_ROWS)
+                page = 1
+                if n_pages > 1:
+                    page = st.number_input(f"Trang heatmap (mỗi trang {HEATMAP_PAGE_ROWS} mã, tổng {n_pages} trang):",
+                                           min_value=1, max_value=n_pages, value=1)
+                st.plotly_chart(heatmap_figure(heatmap_data, *filter_key, page - 1), use_container_width=True)
 
     # --- TRANG 2: CHIẾN LƯỢC ---
     elif menu == "🎯 Phân tích Chiến lược":
         st.title("🎯 Phân Tích Chiến Lược & Ngành")
 
-        if df_f.empty:
+        if len(rows) == 0:
             st.warning("⚠️ Vui lòng mở rộng khoảng thời gian hoặc chọn thêm mã chứng khoán.")
         else:
+            agg = strategy_aggregates(df, rows, *filter_key)
             c1, c2, c3, c4 = st.columns(4)
             with c1:
-                st.metric("Số DN", len(df_f[col_ma].unique()))
+                st.metric("Số DN", agg['n_dn'])
             with c2:
-                st.metric("Rủi ro TB", f"{df_f[col_diem].mean():.2f}")
+                st.metric("Rủi ro TB", f"{agg['mean']:.2f}")
             with c3:
-                st.metric("Báo động", len(df_f[df_f[col_diem] > 50][col_ma].unique()), delta="⚠️")
+                st.metric("Báo động", len(np.unique(fidx['ma_codes'][alert_rows(alerts, rows)])), delta="⚠️")
             with c4:
-                st.metric("Độ ổn định", f"{df_f[col_diem].std():.2f}")
+                st.metric("Độ ổn định", f"{agg['std']:.2f}")
 
             col_l, col_r = st.columns([2, 1])
             with col_l:
-                st.plotly_chart(px.bar(df_f.groupby(col_nganh)[col_diem].mean().reset_index().sort_values(col_diem),
+                st.plotly_chart(px.bar(agg['by_industry'],
                                        x=col_diem, y=col_nganh, orientation='h', color=col_diem,
                                        color_continuous_scale='Reds'), use_container_width=True)
             with col_r:
-                fig_pie = px.pie(df_f, names='Trạng thái', hole=0.6,
+                fig_pie = px.pie(agg['status_counts'], names='Trạng thái', values='count', hole=0.6,
                                  color='Trạng thái',
                                  color_discrete_map={
                                      'AN TOÀN XANH': '#008000',
@@ -195,76 +543,105 @@ if not df.empty:
 
             st.markdown("### 🏆 Bảng xếp hạng Rủi ro (Trong giai đoạn đã chọn)")
             rk1, rk2 = st.columns(2)
-            # Lấy trung bình điểm rủi ro của từng mã trong giai đoạn được chọn để xếp hạng
-            ranking_df = df_f.groupby([col_ma, 'Trạng thái'])[col_diem].mean().reset_index()
-
+            # Xếp hạng theo điểm rủi ro trung bình của từng mã trong giai đoạn được chọn
             with rk1:
                 st.write("🔴 **Top 5 Rủi ro cao nhất:**")
-                st.dataframe(ranking_df.sort_values(by=col_diem, ascending=False).head(5),
-                             hide_index=True)
+                st.dataframe(agg['top_risk'], hide_index=True)
             with rk2:
                 st.write("🟢 **Top 5 An toàn nhất:**")
-                st.dataframe(ranking_df.sort_values(by=col_diem, ascending=True).head(5),
-                             hide_index=True)
+                st.dataframe(agg['top_safe'], hide_index=True)
+
+            st.markdown("### 🚨 Cảnh báo sớm (Trong giai đoạn đã chọn)")
+            alert_table = alerts['table'].loc[np.intersect1d(alerts['rows'], rows, assume_unique=True)]
+            if alert_table.empty:
+                st.success("Không có cảnh báo nào theo bộ ngưỡng hiện tại.")
+            else:
+                st.dataframe(alert_table.sort_values(['Năm', 'Điểm rủi ro'], ascending=False), hide_index=True,
+                             column_config={'Điểm rủi ro': st.column_config.NumberColumn(format="%.2f"),
+                                            'Thay đổi': st.column_config.NumberColumn(format="%+.2f")})
 
     # --- TRANG 3: CẨM NANG ---
     elif menu == "🧭 Cẩm nang Nhà đầu tư":
         st.title("🧭 Phân Tích Chuyên Sâu & Radar")
 
-        if df_f.empty:
+        if len(rows) == 0:
             st.warning("⚠️ Không đủ dữ liệu để vẽ biểu đồ.")
         else:
-            st.plotly_chart(px.sunburst(df_f, path=[col_nganh, col_ma], values=col_diem, color=col_diem,
-                                        color_continuous_scale='RdYlGn_r'), use_container_width=True)
+            st.plotly_chart(sunburst_figure(df, rows, *filter_key), use_container_width=True)
 
             st.markdown("---")
             # Chọn mã từ danh sách ĐÃ LỌC
-            available_tickers = df_f[col_ma].unique()
+            available_tickers = tickers_in_rows(fidx, rows)
             if len(available_tickers) > 0:
                 ticker_radar = st.selectbox("Chọn mã doanh nghiệp:", available_tickers)
 
                 # Lấy dữ liệu mới nhất TRONG KHOẢNG THỜI GIAN ĐÃ CHỌN
-                latest = df_f[df_f[col_ma] == ticker_radar].sort_values('Năm').iloc[-1]
+                latest = latest_record(df, fidx, tidx, ticker_radar, selected_years)
 
-                color_map = {'AN TOÀN XANH': 'rgba(46, 204, 113, 0.5)', 'CẢNH BÁO VÀNG': 'rgba(241, 196, 15, 0.5)',
-                             'BÁO ĐỘNG ĐỎ': 'rgba(231, 76, 60, 0.5)'}
-                line_map = {'AN TOÀN XANH': '#27ae60', 'CẢNH BÁO VÀNG': '#f39c12', 'BÁO ĐỘNG ĐỎ': '#c0392b'}
-                current_color = color_map.get(latest['Trạng thái'], 'rgba(100, 100, 100, 0.5)')
-                current_line = line_map.get(latest['Trạng thái'], '#7f8c8d')
+                current_color = export.STATUS_FILL.get(latest['Trạng thái'], 'rgba(100, 100, 100, 0.5)')
+                current_line = export.STATUS_LINE.get(latest['Trạng thái'], '#7f8c8d')
 
-                # === PHẦN RADAR ===
-                score_safe = 100 - latest[col_diem]
-                val_liq = latest.get('tt_hien_han_tre1', 0)
-                score_liq = min(100, val_liq * 50)
-                val_lev = latest.get('no_tong_tai_san_tre1', 0.5)
-                score_lev = max(0, min(100, (1 - val_lev) * 100))
-                val_prof = latest.get('roa_tre1', 0)
-                score_prof = max(0, min(100, val_prof * 500))
-                val_cash = latest.get('dong_tien_tren_no_tre1', 0)
-                if val_cash > 0.5:
-                    score_cash = 100
-                elif val_cash > 0:
-                    score_cash = 70
-                elif val_cash == 0:
-                    score_cash = 50
-                else:
-                    score_cash = 20
+                # === DOANH NGHIỆP TƯƠNG ĐỒNG (tìm trên toàn bộ Mã x Năm, không chỉ dữ liệu đã lọc) ===
+                peers = peer_scores = None
+                if peer_index is not None:
+                    st.markdown("**👥 Doanh nghiệp có hồ sơ tài chính tương đồng**")
+                    p1, p2, p3, p4 = st.columns([2, 2, 1, 1])
+                    with p1:
+                        k_peers = st.slider("Số mã tương đồng:", 1, 10, 3)
+                    with p2:
+                        metric = st.radio("Khoảng cách:", ["Cosine", "Euclid"], horizontal=True)
+                    with p3:
+                        peer_same_ind = st.checkbox("Cùng ngành")
+                    with p4:
+                        peer_same_year = st.checkbox("Cùng năm", value=True)
+                    peers, peer_scores = find_peers(peer_index, latest.name, k_peers,
+                                                    'cosine' if metric == "Cosine" else 'euclidean',
+                                                    peer_same_ind, peer_same_year)
 
+                # === PHẦN RADAR ===
                 fig_radar = go.Figure()
                 fig_radar.add_trace(go.Scatterpolar(
-                    r=[score_safe, score_liq, score_lev, score_prof, score_cash],
-                    theta=['Độ An toàn (100-Risk)', 'Thanh khoản', 'Cấu trúc Vốn (Ít nợ)', 'Sinh lời (ROA)',
-                           'Dòng tiền'],
+                    r=radar_scores(latest), theta=core.RADAR_AXES,
                     fill='toself', fillcolor=current_color, line=dict(color=current_line), name=ticker_radar
                 ))
+                for peer_pos in (peers if peers is not None else []):
+                    peer = df.iloc[peer_pos]
+                    fig_radar.add_trace(go.Scatterpolar(
+                        r=radar_scores(peer), theta=core.RADAR_AXES, line=dict(dash='dot'),
+                        name=f"{peer[col_ma]} ({peer['Năm']:.0f})"
+                    ))
                 fig_radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 100])),
                                         title=f"Sức khỏe tài chính đa chiều: {ticker_radar} (Năm {latest['Năm']})")
                 st.plotly_chart(fig_radar, use_container_width=True)
 
+                if peers is not None and len(peers):
+                    peer_table = df.iloc[peers][[col_ma, 'Tên công ty', col_nganh, 'Năm', col_diem, 'Trạng thái']]
+                    st.dataframe(peer_table.assign(**{'Độ tương đồng' if metric == "Cosine" else 'Khoảng cách':
+                                                      peer_scores}), hide_index=True)
+                elif peers is not None:
+                    st.info("Không tìm thấy doanh nghiệp tương đồng với điều kiện đã chọn.")
+
+                # Áp lực tài chính chỉ khi điểm vượt ngưỡng / bị hạ bậc; điểm tăng nhanh hay tỷ số xấu đi là tín hiệu theo dõi
+                radar_row = latest.name  # chỉ mục RangeIndex: nhãn dòng = vị trí dòng
+                pressure = [core.ALERT_LABELS[k] for k in ('breach', 'downgrade') if alerts[k][radar_row]]
+                signals = [core.ALERT_LABELS['jump']] if alerts['jump'][radar_row] else []
+                if alerts['ratio_worse'][radar_row]:
+                    signals.append(f"{core.ALERT_LABELS['ratio_worse']} ({alerts['n_worse'][radar_row]} tỷ số giảm "
+                                   f"≥ {dict(rules)['ratio_worsen_pct']:.0f}% so với năm trước)")
+                if pressure:
+                    review = ('⚠️ Khuyến nghị: Doanh nghiệp đang gặp áp lực lớn về tài chính, nhà đầu tư cần rà soát '
+                              'lại cơ cấu nợ và dòng tiền hoạt động (' + ', '.join(pressure) + ').')
+                elif signals:
+                    review = '🟡 Phân tích: Điểm rủi ro chưa tới mức báo động, nhưng có tín hiệu cần theo dõi.'
+                else:
+                    review = ('✅ Phân tích: Các chỉ số vận hành đang nằm trong tầm kiểm soát tốt, đây là vùng an toàn '
+                              'để nắm giữ lâu dài.')
+                if signals:
+                    review += f"<br>🔎 Tín hiệu cần theo dõi: {'; '.join(signals)}."
                 st.markdown(
                     f"""<div class='insight-box'><b>🤖 AI Review chuyên sâu:</b> Mã {ticker_radar} ({latest['Tên công ty']}) hiện có mức rủi ro đạt <b>{latest[col_diem]:.2f}</b> điểm (Năm {latest['Năm']}). 
                 Mức điểm này phản ánh trạng thái <b>{latest['Trạng thái']}</b> của doanh nghiệp trong kỳ báo cáo được chọn. 
-                {'⚠️ Khuyến nghị: Doanh nghiệp đang gặp áp lực lớn về tài chính, nhà đầu tư cần rà soát lại cơ cấu nợ và dòng tiền hoạt động.' if latest[col_diem] > 60 else '✅ Phân tích: Các chỉ số vận hành đang nằm trong tầm kiểm soát tốt, đây là vùng an toàn để nắm giữ lâu dài.'}</div>""",
+                {review}</div>""",
                     unsafe_allow_html=True)
             else:
                 st.info("Vui lòng chọn mã chứng khoán bên thanh menu.")
@@ -274,18 +651,39 @@ if not df.empty:
         st.title("🔮 Stress-Test Kịch Bản")
 
         # Chỉ lấy các mã có trong danh sách đã lọc
-        available_tickers = df_f[col_ma].unique()
+        available_tickers = tickers_in_rows(fidx, rows)
 
         if len(available_tickers) > 0:
             col_in, col_ch = st.columns([1, 2])
             with col_in:
                 target_ma = st.selectbox("Chọn mã giả lập:", available_tickers)
-                s_roa = st.slider("Lợi nhuận thay đổi (%)", -10.0, 10.0, 0.0)
-                s_debt = st.slider("Nợ thay đổi (%)", -20.0, 20.0, 0.0)
+                methods = (["Mô hình (chỉ số tài chính)"] if engine is not None else []) + ["Công thức tuyến tính"]
+                method = st.radio("Phương pháp chấm điểm:", methods, horizontal=True)
+                use_model = method == "Mô hình (chỉ số tài chính)"
+                if use_model:
+                    # Mô hình: % thay đổi tương đối áp lên các tỷ số tài chính đầu vào
+                    lim, step = core.MODEL_SHOCK_LIMIT, core.MODEL_SHOCK_STEP
+                    roa_label, debt_label = "Lợi nhuận thay đổi (% tương đối trên tỷ số)", \
+                        "Nợ thay đổi (% tương đối trên tỷ số)"
+                    roa_lim, debt_lim = lim, lim
+                else:
+                    # Công thức tuyến tính: mỗi % sốc đổi thẳng thành điểm rủi ro theo hệ số cố định
+                    step = 1.0
+                    roa_label, debt_label = "Lợi nhuận thay đổi (%)", "Nợ thay đổi (%)"
+                    roa_lim, debt_lim = 10.0, 20.0
+                s_roa = st.slider(roa_label, -roa_lim, roa_lim, 0.0, step=step)
+                s_debt = st.slider(debt_label, -debt_lim, debt_lim, 0.0, step=step)
 
                 # Lấy base là năm GẦN NHẤT trong khoảng thời gian đã chọn
-                base = df_f[df_f[col_ma] == target_ma].sort_values('Năm').iloc[-1][col_diem]
-                sim_score = max(0, min(100, base - (s_roa * 2) + (s_debt * 0.8)))
+                base_row = latest_record(df, fidx, tidx, target_ma, selected_years)
+                base = base_row[col_diem]
+                if use_model:
+                    base_pos = df.index.get_loc(base_row.name)
+                    sim_score = float(model_stress_scores(engine, [base_pos], [s_roa], [s_debt])[0, 0, 0])
+                    st.caption(f"Mô hình thay thế: R² logit = {engine['r2']:.2f}; dùng {int(engine['active'].sum())}/"
+                               f"{len(engine['features'])} biến *_tre1 (biến ngược dấu kỳ vọng bị loại).")
+                else:
+                    sim_score = float(stress_scores([base], [s_roa], [s_debt])[0, 0, 0])
 
             with col_ch:
                 st.plotly_chart(
@@ -296,13 +694,59 @@ if not df.empty:
                     use_container_width=True)
 
             st.write(
-                f"**So sánh Điểm Gốc (Năm {df_f[df_f[col_ma] == target_ma].sort_values('Năm').iloc[-1]['Năm']}) và Dự báo:**")
+                f"**So sánh Điểm Gốc (Năm {base_row['Năm']}) và Dự báo:**")
             fig_bullet = go.Figure(
                 go.Bar(name='Hiện tại', y=[target_ma], x=[base], orientation='h', marker_color='#95a5a6'))
             fig_bullet.add_trace(
                 go.Bar(name='Dự báo', y=[target_ma], x=[sim_score], orientation='h', marker_color='#e74c3c'))
             fig_bullet.update_layout(barmode='group', height=200)
             st.plotly_chart(fig_bullet, use_container_width=True)
+
+            # === STRESS-TEST HÀNG LOẠT: mọi mã x mọi kịch bản trong một lần tính ===
+            st.markdown("---")
+            st.markdown("### 🧮 Stress-test hàng loạt theo lưới kịch bản")
+            b1, b2, b3 = st.columns(3)
+            with b1:
+                scope = st.radio("Phạm vi:", ["Các mã đang lọc", "Toàn thị trường"], horizontal=True)
+            with b2:
+                roa_range = st.slider(f"Dải {roa_label[0].lower()}{roa_label[1:]}", -roa_lim, roa_lim,
+                                      (-roa_lim, roa_lim), step=step)
+            with b3:
+                debt_range = st.slider(f"Dải {debt_label[0].lower()}{debt_label[1:]}", -debt_lim, debt_lim,
+                                       (-debt_lim, debt_lim), step=step)
+            codes_in_scope = full_list_ma if scope == "Toàn thị trường" else sel_ma
+            batch = batch_stress(df, fidx, tidx, engine, data_version,
+                                 None if scope == "Toàn thị trường" else tuple(sel_ma), selected_years,
+                                 roa_range, debt_range, use_model)
+            roa_grid, debt_grid, codes = batch['roa_grid'], batch['debt_grid'], batch['codes']
+            batch_base, batch_scores, red_counts = batch['base'], batch['scores'], batch['red_counts']
+
+            st.plotly_chart(px.imshow(red_counts, x=debt_grid, y=roa_grid, origin='lower', aspect='auto',
+                                      color_continuous_scale='Reds',
+                                      labels=dict(x=debt_label, y=roa_label, color="Số mã ≥ 70"),
+                                      title=f"Số mã rơi vào BÁO ĐỘNG ĐỎ trên {len(batch_base)}/"
+                                            f"{len(codes_in_scope)} mã có dữ liệu"),
+                            use_container_width=True)
+
+            # Chi tiết cho kịch bản gần nhất với 2 thanh trượt phía trên
+            i_roa = int(np.abs(roa_grid - s_roa).argmin())
+            i_debt = int(np.abs(debt_grid - s_debt).argmin())
+            st.write(f"**Chuyển trạng thái tại kịch bản Lợi nhuận {roa_grid[i_roa]:+.0f}% / "
+                     f"Nợ {debt_grid[i_debt]:+.0f}%:**")
+            transitions = batch['transitions'][i_roa * len(debt_grid) + i_debt]
+            st.dataframe(pd.DataFrame(transitions, index=[f"Từ {s}" for s in STATUS_LABELS],
+                                      columns=[f"Sang {s}" for s in STATUS_LABELS]))
+
+            scen = batch_scores[:, i_roa, i_debt]
+            crossed = (batch_base < STATUS_BINS[1]) & (scen >= STATUS_BINS[1])
+            if crossed.any():
+                st.write(f"🔴 **{int(crossed.sum())} mã vượt ngưỡng {STATUS_BINS[1]} điểm trong kịch bản này:**")
+                st.dataframe(pd.DataFrame({col_ma: fidx['ma_categories'][codes[crossed]],
+                                           'Điểm gốc': batch_base[crossed],
+                                           'Điểm sau sốc': scen[crossed]})
+                             .sort_values('Điểm sau sốc', ascending=False), hide_index=True)
+            else:
+                st.info("Không có mã nào vượt ngưỡng báo động đỏ trong kịch bản này.")
         else:
             st.warning("Không có mã chứng khoán nào để mô phỏng. Vui lòng kiểm tra bộ lọc.")
 
@@ -317,7 +761,8 @@ if not df.empty:
                  "content": "Chào bạn! Tôi có thể **phân tích chuyên sâu** và **vẽ biểu đồ** cho bất kỳ mã cổ phiếu nào. Hãy thử nhập: *'Phân tích VNM'* hoặc *'Tình hình VIC thế nào'*."}
             ]
 
-        # Hiển thị lịch sử chat cũ
+        # Hiển thị lịch sử chat cũ (có giới hạn: tin cũ được gộp thành một tin tóm tắt)
+        st.session_state.messages = compact_chat(st.session_state.messages, matcher)
         for m in st.session_state.messages:
             with st.chat_message(m["role"]):
                 st.markdown(m["content"])
@@ -329,36 +774,58 @@ if not df.empty:
                 st.markdown(prompt)
 
             with st.chat_message("assistant"):
-                # Placeholder để tạo hiệu ứng suy nghĩ
-                status_placeholder = st.empty()
-                status_placeholder.markdown("⏳ *AI đang phân tích dữ liệu thị trường...*")
-                time.sleep(0.8)  # Giả lập độ trễ xử lý
-                status_placeholder.empty()
-
                 p_up = prompt.upper()
                 # Tìm trong FULL list (Chatbot nên biết hết, không bị ảnh hưởng bởi bộ lọc bên trái)
-                found = [m for m in full_list_ma if m in p_up]
+                found = match_tickers(matcher, prompt)
+
+                # --- TRƯỜNG HỢP 0: NHIỀU MÃ -> SO SÁNH ---
+                if len(found) > 1:
+                    records = [latest_record(df, fidx, tidx, m) for m in found]
+                    compare = pd.DataFrame({
+                        col_ma: found,
+                        'Tên công ty': [r['Tên công ty'] for r in records],
+                        'Năm': [r['Năm'] for r in records],
+                        col_diem: [r[col_diem] for r in records],
+                        'Trạng thái': [r['Trạng thái'] for r in records],
+                    }).sort_values(col_diem, ascending=False)
+                    riskiest, safest = compare.iloc[0], compare.iloc[-1]
+                    response_text = (f"### ⚖️ So sánh {', '.join(found)}\n"
+                                     f"**{riskiest[col_ma]}** đang rủi ro nhất ({riskiest[col_diem]:.1f} điểm), "
+                                     f"**{safest[col_ma]}** an toàn nhất ({safest[col_diem]:.1f} điểm).")
+                    st.markdown(response_text)
+                    st.dataframe(compare, hide_index=True)
+
+                    history = pd.concat([ticker_history(df, fidx, tidx, m) for m in found])
+                    fig_cmp = px.line(history, x='Năm', y=col_diem, color=col_ma, markers=True, height=250)
+                    fig_cmp.update_layout(margin=dict(l=0, r=0, t=0, b=0), xaxis_title=None,
+                                          yaxis_title="Điểm Rủi ro")
+                    st.plotly_chart(fig_cmp, use_container_width=True)
+                    st.session_state.messages.append({"role": "assistant", "content": response_text})
 
                 # --- TRƯỜNG HỢP 1: TÌM THẤY MÃ CỔ PHIẾU ---
-                if found:
+                elif found:
                     m_code = found[0]
 
                     # Lấy dữ liệu mới nhất (Từ DF gốc, không phải DF_F đã lọc)
-                    d_latest = df[df[col_ma] == m_code].sort_values('Năm').iloc[-1]
+                    d_latest = latest_record(df, fidx, tidx, m_code)
                     score = d_latest[col_diem]
                     status = d_latest['Trạng thái']
 
                     # Lấy dữ liệu lịch sử để vẽ biểu đồ mini
-                    d_history = df[df[col_ma] == m_code].sort_values('Năm')
+                    d_history = ticker_history(df, fidx, tidx, m_code)
 
                     # 1. Tạo nội dung Text
                     response_text = f"### 🔍 Kết quả phân tích {m_code} ({d_latest['Tên công ty']})\n"
-                    if score < 30:
+                    level = status_codes(score)
+                    if level == 0:
                         response_text += f"**Đánh giá:** ✅ Doanh nghiệp đang rất **AN TOÀN**. Cấu trúc tài chính vững mạnh."
-                    elif score < 60:
+                    elif level == 1:
                         response_text += f"**Đánh giá:** ⚠️ Doanh nghiệp ở mức **CẢNH BÁO**. Cần theo dõi sát các khoản nợ ngắn hạn."
                     else:
                         response_text += f"**Đánh giá:** 🚨 **BÁO ĐỘNG ĐỎ**. Rủi ro tài chính rất cao, nguy cơ mất thanh khoản."
+                    chat_alerts = alert_labels(alerts, d_latest.name)
+                    if chat_alerts:
+                        response_text += f"\n\n**🚨 Cảnh báo sớm (năm {d_latest['Năm']:.0f}):** " + ", ".join(chat_alerts)
 
                     # 2. Hiển thị Metrics đẹp mắt ngay trong Chat
                     c1, c2, c3 = st.columns(3)
@@ -379,7 +846,7 @@ if not df.empty:
                                            xaxis_title=None, yaxis_title="Điểm Rủi ro",
                                            showlegend=False)
 
-                    if score > 50:
+                    if alerts['breach'][d_latest.name]:
                         fig_mini.update_traces(line_color='#e74c3c', fillcolor='rgba(231, 76, 60, 0.3)')
                     else:
                         fig_mini.update_traces(line_color='#2ecc71', fillcolor='rgba(46, 204, 113, 0.3)')
@@ -405,5 +872,172 @@ if not df.empty:
                     response_text = "Tôi chưa hiểu ý bạn. Hãy thử nhập một mã chứng khoán cụ thể (Ví dụ: **NVL**, **VIC**, **VNM**) để tôi phân tích biểu đồ cho bạn xem nhé!"
                     st.markdown(response_text)
                     st.session_state.messages.append({"role": "assistant", "content": response_text})
+
+    # --- TRANG 6: XUẤT FILE & BÁO CÁO ---
+    elif menu == EXPORT_PAGE:
+        st.title("📤 Xuất Dữ Liệu & Báo Cáo")
+
+        if len(rows) == 0:
+            st.warning("⚠️ Không có dữ liệu nào theo bộ lọc hiện tại.")
+        else:
+            st.markdown(f"Bộ lọc hiện tại: **{len(tickers_in_rows(fidx, rows))}** mã, **{len(rows):,}** dòng dữ liệu.")
+
+            st.markdown("### 📄 Xuất bảng dữ liệu")
+            # File chỉ được ghi (theo từng khối) khi người dùng bấm tải, không tốn gì ở các lần rerun khác
+            tables = {
+                "Dữ liệu đã lọc (từng dòng)": lambda: export.iter_chunks(df, rows),
+                "Ảnh chụp mới nhất + điểm radar": lambda: [
+                    export.snapshot_table(df, fidx, tidx, rows, selected_years, alerts)],
+                "Heatmap Mã x Năm": lambda: [overview_aggregates(df, rows, *filter_key).reset_index()],
+            }
+            e1, e2 = st.columns(2)
+            with e1:
+                table_name = st.radio("Bảng:", list(tables))
+            with e2:
+                fmt = st.radio("Định dạng:", export.available_formats())
+            ext, mime = export.EXPORT_FORMATS[fmt]
+            st.download_button(f"⬇️ Tải {fmt}", data=lambda: export.export_file(tables[table_name](), fmt),
+                               file_name=f"rui_ro_{ext}_export.{ext}", mime=mime, on_click="ignore")
+
+            st.markdown("### 🧾 Báo cáo nhiều mã (HTML)")
+            st.caption(f"Gồm xếp hạng, heatmap, ảnh chụp từng mã và radar + xu hướng của tối đa "
+                       f"{export.REPORT_MAX_TICKERS} mã rủi ro cao nhất. Mở bằng trình duyệt, in ra PDF bằng Ctrl+P.")
+            job_key = filter_key + (rules,)
+            job = report_job(job_key)
+            if job is None:
+                if st.button("🛠️ Tạo báo cáo"):
+                    submit_report(job_key, df, fidx, tidx, rows, year_range=selected_years, alerts=alerts)
+                    st.rerun()
+            elif not job.done():
+                wait_for_report(job)
+            elif job.exception() is not None:
+                st.error(f"❌ Lỗi khi dựng báo cáo: {job.exception()}")
+                if st.button("🔁 Thử lại"):
+                    submit_report(job_key, df, fidx, tidx, rows, year_range=selected_years, alerts=alerts)
+                    st.rerun()
+            else:
+                doc, stats = job.result()
+                st.success(f"✅ Đã dựng {stats['tickers']} mã trong {stats['seconds']:.1f}s "
+                           f"(dùng lại {stats['cache_hits']} biểu đồ đã vẽ, vẽ mới {stats['cache_misses']}).")
+                st.download_button("⬇️ Tải báo cáo HTML", data=doc, file_name="bao_cao_rui_ro.html",
+                                   mime="text/html", on_click="ignore")
+
+    # --- TRANG 7: DANH MỤC ĐẦU TƯ ---
+    elif menu == PORTFOLIO_PAGE:
+        st.title("💼 Rủi Ro Danh Mục Đầu Tư")
+
+        upload_types = portfolio.upload_types()
+        uploaded = st.file_uploader(f"Tải file danh mục ({'/'.join(t.upper() for t in upload_types)}, cột mã `ma_ck` "
+                                    f"và tỷ trọng `ty_trong`/`gia_tri`):", type=upload_types)
+        st.download_button("⬇️ File mẫu", portfolio.SAMPLE_HOLDINGS, file_name="danh_muc_mau.csv", mime="text/csv",
+                           on_click="ignore")
+        if uploaded is not None:
+            raw, file_name = uploaded.getvalue(), uploaded.name
+        else:
+            # Chưa có file: coi các mã đang chọn ở thanh bên là danh mục tỷ trọng đều
+            st.caption("Chưa tải file: đang dùng các mã đang chọn ở thanh bên, tỷ trọng bằng nhau.")
+            raw, file_name = ("ma_ck\n" + "\n".join(sel_ma)).encode('utf-8'), "sidebar.csv"
+
+        holdings_key = portfolio.holdings_hash(raw)
+        try:
+            holdings = parse_holdings(raw, holdings_key, file_name)
+        except Exception as e:
+            st.error(f"❌ Không đọc được file danh mục: {e}")
+            holdings = None
+
+        if holdings is not None and holdings.attrs.get('invalid'):
+            st.warning("⚠️ Bỏ qua dòng có tỷ trọng không hợp lệ (không phải số dương): "
+                       + ", ".join(f"{ma} ({w})" for ma, w in holdings.attrs['invalid']))
+        if holdings is None or holdings.empty:
+            st.warning("⚠️ Danh mục trống. Vui lòng tải file hoặc chọn mã ở thanh bên.")
+        else:
+            window = st.slider("Cửa sổ tính biến động (năm):", 2, 5, portfolio.ROLLING_YEARS)
+            pm = portfolio_metrics(df, fidx, tidx, holdings, holdings_key, data_version, selected_years, window)
+            if pm['missing']:
+                st.warning(f"⚠️ Không có dữ liệu trong giai đoạn đã chọn cho: {', '.join(pm['missing'])}")
+
+            if pm['coverage'] == 0:
+                st.info("Không mã nào trong danh mục có dữ liệu để tính toán.")
+            else:
+                c1, c2, c3, c4 = st.columns(4)
+                with c1:
+                    st.metric("Điểm rủi ro (theo tỷ trọng)", f"{pm['weighted_score']:.2f}")
+                with c2:
+                    st.metric("Xác suất vỡ nợ (theo tỷ trọng)", f"{pm['weighted_prob']:.1%}")
+                with c3:
+                    st.metric("Tập trung ngành (HHI)", f"{pm['hhi']:.2f}",
+                              delta=f"≈ {pm['effective_industries']:.1f} ngành hiệu dụng", delta_color="off")
+                with c4:
+                    st.metric("Tỷ trọng có dữ liệu", f"{pm['coverage']:.0%}")
+
+                col_l, col_r = st.columns(2)
+                with col_l:
+                    st.plotly_chart(px.bar(pm['by_industry'], x='Tỷ trọng', y=col_nganh, orientation='h',
+                                           title="Cơ cấu ngành (theo tỷ trọng)"), use_container_width=True)
+                with col_r:
+                    fig_pf = px.line(pm['yearly'], x='Năm', y=['Điểm danh mục', 'Biến động danh mục'], markers=True,
+                                     title=f"Điểm danh mục và độ lệch chuẩn trượt {window} năm")
+                    fig_pf.update_layout(yaxis_title=None, legend_title=None)
+                    st.plotly_chart(fig_pf, use_container_width=True)
+
+                st.dataframe(pm['table'], hide_index=True, column_config={
+                    'Tỷ trọng': st.column_config.NumberColumn(format="percent"),
+                    'Năm': st.column_config.NumberColumn(format="%d"),
+                    'Điểm rủi ro': st.column_config.NumberColumn(format="%.2f"),
+                    'xac_suat': st.column_config.NumberColumn("Xác suất vỡ nợ", format="%.3f"),
+                    f'Biến động {window} năm': st.column_config.NumberColumn(format="%.2f"),
+                    'Đóng góp rủi ro': st.column_config.ProgressColumn(min_value=0.0, max_value=1.0, format="%.2f"),
+                })
+
+    # --- TRANG ẨN: DIAGNOSTICS (chỉ hiện khi bật đo hiệu năng) ---
+    elif menu == DIAG_PAGE:
+        st.title(DIAG_PAGE)
+        store = _perf_store()
+        with store['lock']:
+            runs = list(store['runs'])
+            calls, misses = dict(store['calls']), dict(store['misses'])
+            sessions = dict(store['sessions'])
+
+        if runs:
+            timings = pd.DataFrame([r['stages_ms'] for r in runs])
+            summary = pd.DataFrame({
+                'Số lần': timings.count(),
+                'p50 (ms)': timings.median(),
+                'p95 (ms)': timings.quantile(0.95),
+                'Max (ms)': timings.max(),
+            }).sort_values('p95 (ms)', ascending=False)
+            st.markdown(f"### ⏱️ Thời gian theo giai đoạn ({len(runs)} lần rerun gần nhất)")
+            st.dataframe(summary.style.format("{:.1f}", subset=['p50 (ms)', 'p95 (ms)', 'Max (ms)']))
+
+            rss = pd.DataFrame({'Lần rerun': range(len(runs)),
+                                'RSS (MB)': [max(r['rss_mb'].values(), default=np.nan) for r in runs]})
+            st.plotly_chart(px.line(rss, x='Lần rerun', y='RSS (MB)', title="Bộ nhớ tiến trình"),
+                            use_container_width=True)
+            st.download_button("⬇️ Tải số liệu (CSV)", timings.to_csv(index=False).encode('utf-8'),
+                               file_name="perf_runs.csv", mime="text/csv")
+        else:
+            st.info("Chưa có số liệu. Hãy chuyển qua vài trang khác rồi quay lại.")
+
+        st.markdown("### 👥 Bộ nhớ theo phiên")
+        shared_mb = df.memory_usage(deep=True).sum() / 2 ** 20
+        s1, s2, s3 = st.columns(3)
+        s1.metric("Dữ liệu dùng chung", f"{shared_mb:.1f} MB")
+        s2.metric("Số phiên đang hoạt động", len(sessions))
+        s3.metric("Session state TB / phiên", f"{np.mean([u['state_kb'] for u in sessions.values()] or [0]):.1f} KB")
+        if sessions:
+            session_df = pd.DataFrame.from_dict(sessions, orient='index').rename(columns={
+                'state_kb': 'Session state (KB)', 'keys': 'Số khóa', 'messages': 'Tin nhắn chat'})
+            session_df['Rerun gần nhất'] = pd.to_datetime(session_df.pop('ts'), unit='s')
+            st.dataframe(session_df.sort_values('Session state (KB)', ascending=False)
+                         .style.format("{:.1f}", subset=['Session state (KB)']))
+
+        st.markdown("### 🗃️ Tỷ lệ trúng cache")
+        cache_df = pd.DataFrame({'Lượt gọi': pd.Series(calls), 'Tính lại': pd.Series(misses)}).fillna(0).astype(int)
+        cache_df['Tỷ lệ trúng'] = 1 - cache_df['Tính lại'] / cache_df['Lượt gọi'].where(cache_df['Lượt gọi'] > 0)
+        st.dataframe(cache_df.sort_values('Lượt gọi', ascending=False).style.format("{:.1%}", subset=['Tỷ lệ trúng']))
+        st.caption(f"Log JSONL (mỗi dòng một lần rerun, xoay vòng khi vượt "
+                   f"{PERF_LOG_MAX_BYTES // (1024 * 1024)} MB): {PERF_LOG_FILE}")
 else:
-    st.error("💡 Thiếu file 'ket_qua_du_bao.csv'.")
\ No newline at end of file
+    st.error("💡 Thiếu file 'ket_qua_du_bao.csv'.")
+
+perf_finish_run()
\ No newline at end of file
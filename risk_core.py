@@ -0,0 +1,799 @@
+"""Logic dữ liệu của dashboard (không phụ thuộc Streamlit).
+
+code_app.py bọc các hàm ở đây bằng cache của Streamlit và dựng giao diện; benchmark.py gọi trực tiếp
+để đo hiệu năng mà không cần mở trình duyệt.
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # Không có pyarrow -> bỏ qua cache cột, đọc thẳng CSV
+    pa = feather = None
+
+
+# 1. HÀM LOAD DATA
+DATA_FILE = "ket_qua_du_bao.csv"
+INCOMING_DIR = "du_lieu_moi"  # Thả file CSV kỳ báo cáo mới (cùng cấu trúc) vào đây
+CACHE_DIR = ".cache"
+CACHE_VERSION = 2
+CATEGORY_COLS = ['Mã doanh nghiệp', 'Ngành nghề', 'Trạng thái']
+# Cột điểm hiển thị trực tiếp trên bảng/biểu đồ: giữ float64 để không lộ sai số float32 (84.910004)
+FULL_PRECISION_COLS = ['Năm', 'Điểm rủi ro', 'xac_suat']
+MERGE_KEY = ['Mã doanh nghiệp', 'Ngày báo cáo']
+REQUIRED_COLS = ['Mã doanh nghiệp', 'Ngày báo cáo', 'Ngành nghề', 'Điểm rủi ro', 'Trạng thái']
+
+
+def data_dir():
+    """Thư mục dữ liệu; đọc RISK_DATA_DIR ở mỗi lần gọi (vd. benchmark.py trỏ sang dữ liệu tổng hợp)."""
+    return os.environ.get('RISK_DATA_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+
+def _cache_paths(file_path, suffix=""):
+    cache_dir = os.path.join(os.path.dirname(file_path), CACHE_DIR)
+    base = os.path.splitext(os.path.basename(file_path))[0] + suffix
+    return os.path.join(cache_dir, base + ".feather"), os.path.join(cache_dir, base + ".meta.json")
+
+
+def _file_stat(file_path):
+    stat = os.stat(file_path)
+    return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def _file_hash(file_path):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _atomic_write_json(path, obj):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def _parse_csv(raw):
+    """Đọc CSV gốc, chuẩn hóa tên cột, ngày tháng và kiểu dữ liệu gọn nhẹ."""
+    df = pd.read_csv(io.BytesIO(raw), encoding='utf-8-sig')
+    df.columns = df.columns.str.strip()
+    if 'ten_cong_ty' in df.columns:
+        df.loc[df['ma_ck'] == 'VNM', 'ten_cong_ty'] = 'CTCP Sữa Việt Nam (Vinamilk)'
+    mapping = {
+        'ma_ck': 'Mã doanh nghiệp', 'ten_cong_ty': 'Tên công ty',
+        'nganh': 'Ngành nghề', 'ngay': 'Ngày báo cáo',
+        'diem_tin_dung': 'Điểm rủi ro', 'trang_thai': 'Trạng thái'
+    }
+    df = df.rename(columns=mapping)
+    if 'Ngày báo cáo' in df.columns:
+        df['Ngày báo cáo'] = pd.to_datetime(df['Ngày báo cáo'], errors='coerce')
+        df['Năm'] = df['Ngày báo cáo'].dt.year
+    return _compact_dtypes(df)
+
+
+def _compact_dtypes(df):
+    """Kiểu dữ liệu gọn: category cho cột lặp lại nhiều, float32 cho chỉ số tài chính."""
+    for col in CATEGORY_COLS:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    float_cols = df.select_dtypes(include='float64').columns.drop(FULL_PRECISION_COLS, errors='ignore')
+    df[float_cols] = df[float_cols].apply(pd.to_numeric, downcast='float')
+    return df
+
+
+def _read_cache(file_path):
+    """Trả về DataFrame từ cache cột (Arrow/Feather) nếu cache còn khớp với file CSV, ngược lại None."""
+    cache_path, meta_path = _cache_paths(file_path)
+    if feather is None or not (os.path.exists(cache_path) and os.path.exists(meta_path)):
+        return None
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION:
+            return None
+        stat = _file_stat(file_path)
+        if (meta.get('mtime_ns'), meta.get('size')) != (stat['mtime_ns'], stat['size']):
+            # mtime đổi (copy/deploy lại) nhưng nội dung có thể giữ nguyên -> so sánh hash
+            if meta.get('sha1') != _file_hash(file_path):
+                return None
+            meta.update(stat)
+            _atomic_write_json(meta_path, meta)
+        df = feather.read_table(cache_path, memory_map=True).to_pandas()
+        df.attrs['data_version'] = meta.get('sha1')
+        return df
+    except (OSError, ValueError, pa.ArrowException):
+        return None
+
+
+def _write_cache(df, cache_path, meta_path, meta):
+    """Ghi Feather + meta theo kiểu atomic; lỗi ghi cache không làm hỏng việc load dữ liệu."""
+    if feather is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        feather.write_feather(df, tmp, compression='uncompressed')
+        os.replace(tmp, cache_path)
+        _atomic_write_json(meta_path, {'version': CACHE_VERSION, **meta})
+    except (OSError, pa.ArrowException):
+        pass
+
+
+def _build_cache(file_path):
+    """Parse lại CSV và ghi cache cột."""
+    stat = _file_stat(file_path)
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    sha1 = hashlib.sha1(raw).hexdigest()
+    df = _parse_csv(raw)
+    df.attrs['data_version'] = sha1
+    _write_cache(df, *_cache_paths(file_path), {'sha1': sha1, **stat})
+    return df
+
+
+# --- Nạp tăng dần các kỳ báo cáo mới từ thư mục INCOMING_DIR ---
+def _incoming_files(base_dir):
+    folder = os.path.join(base_dir, INCOMING_DIR)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith('.csv'))
+
+
+def data_signature(base_dir=None):
+    """(tên, mtime, size) của CSV gốc và các file kỳ mới; chỉ stat file nên gọi được ở mỗi lần rerun."""
+    base_dir = base_dir or data_dir()
+    signature = []
+    for path in [os.path.join(base_dir, DATA_FILE)] + _incoming_files(base_dir):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _validate_increment(inc, base_columns):
+    missing = [c for c in REQUIRED_COLS if c not in inc.columns]
+    if missing:
+        raise ValueError(f"thiếu cột {missing}")
+    unknown = sorted(set(inc.columns) - set(base_columns))
+    if unknown:
+        raise ValueError(f"cột không có trong dữ liệu gốc {unknown}")
+    if inc['Ngày báo cáo'].isna().any():
+        raise ValueError("có ngày báo cáo không đọc được")
+    if inc.duplicated(MERGE_KEY).any():
+        raise ValueError("trùng khóa (ma_ck, ngay)")
+    score = inc['Điểm rủi ro']
+    if not pd.api.types.is_numeric_dtype(score) or not score.between(0, 100).all():
+        raise ValueError("điểm rủi ro nằm ngoài khoảng 0-100")
+
+
+def _merge_increments(base, increments):
+    """Gộp các kỳ mới theo khóa (Mã, Ngày): dòng mới ghi đè dòng cũ cùng khóa."""
+    new = pd.concat(increments, ignore_index=True).drop_duplicates(MERGE_KEY, keep='last')
+    base_keys = pd.MultiIndex.from_arrays([base[MERGE_KEY[0]].astype(str), base[MERGE_KEY[1]]])
+    new_keys = pd.MultiIndex.from_arrays([new[MERGE_KEY[0]].astype(str), new[MERGE_KEY[1]]])
+    merged = pd.concat([base[~base_keys.isin(new_keys)], new], ignore_index=True)
+    for col in CATEGORY_COLS:
+        if col in merged.columns:
+            merged[col] = merged[col].astype(str).where(merged[col].notna())
+    return _compact_dtypes(merged)
+
+
+def _apply_increments(base, base_dir):
+    """Áp các file kỳ mới lên dữ liệu gốc; kết quả gộp được cache theo (dữ liệu gốc, nội dung các file)."""
+    files = _incoming_files(base_dir)
+    if not files:
+        return base
+    base_version = base.attrs['data_version']
+    digests = [(os.path.basename(p), _file_hash(p)) for p in files]
+    version = hashlib.sha1(json.dumps([base_version, digests]).encode()).hexdigest()
+
+    cache_path, meta_path = _cache_paths(os.path.join(base_dir, DATA_FILE), suffix=".merged")
+    if feather is not None and os.path.exists(cache_path) and os.path.exists(meta_path):
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('version') == CACHE_VERSION and meta.get('data_version') == version:
+                df = feather.read_table(cache_path, memory_map=True).to_pandas()
+                df.attrs.update({k: meta[k] for k in ('data_version', 'base_version', 'ticker_stamps', 'rejected')})
+                return df
+        except (OSError, ValueError, pa.ArrowException):
+            pass
+
+    increments, touched, rejected = [], {}, []
+    for path, (name, digest) in zip(files, digests):
+        try:
+            with open(path, 'rb') as f:
+                inc = _parse_csv(f.read())
+            _validate_increment(inc, base.columns)
+        except (OSError, ValueError, pd.errors.ParserError) as e:
+            rejected.append([name, str(e)])
+            continue
+        increments.append(inc)
+        for ma in inc['Mã doanh nghiệp'].astype(str).unique():
+            touched[ma] = touched.get(ma, '') + digest
+
+    df = _merge_increments(base, increments) if increments else base.copy()
+    attrs = {
+        'data_version': version,
+        'base_version': base_version,
+        # Dấu phiên bản riêng của từng mã bị kỳ mới chạm tới: cache theo bộ lọc của các mã khác vẫn dùng lại được
+        'ticker_stamps': {ma: hashlib.sha1(v.encode()).hexdigest()[:12] for ma, v in touched.items()},
+        'rejected': rejected,
+    }
+    df.attrs.update(attrs)
+    _write_cache(df, cache_path, meta_path, attrs)
+    return df
+
+
+def selection_stamp(df, sel_ma):
+    """Phiên bản dữ liệu của riêng các mã đang chọn: chỉ đổi khi dữ liệu gốc hoặc kỳ mới của các mã này đổi."""
+    base_version = df.attrs.get('base_version', df.attrs.get('data_version'))
+    stamps = df.attrs.get('ticker_stamps', {})
+    touched = ''.join(stamps[m] for m in sel_ma if m in stamps)
+    return hashlib.sha1(f"{base_version}{touched}".encode()).hexdigest() if touched else base_version
+
+
+def load_dataset(base_dir=None):
+    """Đọc dữ liệu (cache cột hoặc CSV gốc) và áp các kỳ mới; DataFrame rỗng nếu thiếu file CSV."""
+    base_dir = base_dir or data_dir()
+    # LƯU Ý: Đảm bảo tên file CSV khớp với file bạn đã xuất ra
+    file_path = os.path.join(base_dir, DATA_FILE)
+    if not os.path.exists(file_path):
+        return pd.DataFrame()
+    df = _read_cache(file_path)
+    if df is None:
+        df = _build_cache(file_path)
+    return _apply_increments(df, base_dir)
+
+
+# 2. CHỈ MỤC BỘ LỌC VÀ TRA CỨU THEO MÃ
+def build_filter_index(df):
+    """Mã hóa (Ngành, Mã, Năm) thành mảng số nguyên một lần cho mỗi phiên bản dữ liệu."""
+    nganh = pd.Categorical(df['Ngành nghề'].astype(str))
+    ma = pd.Categorical(df['Mã doanh nghiệp'].astype(str))
+    n_nganh, n_ma = len(nganh.categories), len(ma.categories)
+    # Mã -1 (thiếu dữ liệu) trỏ về ô cuối luôn False trong bảng tra
+    nganh_codes = np.where(nganh.codes < 0, n_nganh, nganh.codes)
+    ma_codes = np.where(ma.codes < 0, n_ma, ma.codes)
+
+    # Ma trận Ngành x Mã: dùng để lấy nhanh danh sách mã theo ngành đã chọn
+    presence = np.zeros((n_nganh + 1, n_ma + 1), dtype=bool)
+    presence[nganh_codes, ma_codes] = True
+
+    years = df['Năm'].to_numpy(dtype='float64') if 'Năm' in df.columns else None
+    has_years = years is not None and not np.isnan(years).all()
+    return {
+        'list_nganh': sorted(nganh.categories),
+        'list_ma': sorted(ma.categories),
+        'nganh_pos': {n: i for i, n in enumerate(nganh.categories)},
+        'ma_pos': {m: i for i, m in enumerate(ma.categories)},
+        'ma_categories': np.asarray(ma.categories, dtype=object),
+        'nganh_codes': nganh_codes,
+        'ma_codes': ma_codes,
+        'presence': presence[:, :n_ma],
+        'years': years,
+        'year_range': (int(np.nanmin(years)), int(np.nanmax(years))) if has_years else None,
+    }
+
+
+def _lookup_mask(pos, selected, size):
+    mask = np.zeros(size + 1, dtype=bool)
+    mask[[pos[v] for v in selected if v in pos]] = True
+    return mask
+
+
+def tickers_for_industries(fidx, sel_ind):
+    """Danh sách mã (đã sắp xếp) thuộc các ngành được chọn."""
+    ind_ok = _lookup_mask(fidx['nganh_pos'], sel_ind, len(fidx['nganh_pos']))
+    present = fidx['presence'][ind_ok].any(axis=0)
+    return sorted(fidx['ma_categories'][present])
+
+
+def select_rows(fidx, sel_ind, sel_ma, year_range):
+    """Vị trí các dòng thỏa cả 3 bộ lọc, tính bằng một mặt nạ duy nhất."""
+    ind_ok = _lookup_mask(fidx['nganh_pos'], sel_ind, len(fidx['nganh_pos']))
+    ma_ok = _lookup_mask(fidx['ma_pos'], sel_ma, len(fidx['ma_pos']))
+    mask = ind_ok[fidx['nganh_codes']] & ma_ok[fidx['ma_codes']]
+    if year_range is not None:
+        years = fidx['years']
+        mask &= (years >= year_range[0]) & (years <= year_range[1])
+    return np.flatnonzero(mask)
+
+
+def tickers_in_rows(fidx, rows):
+    """Danh sách mã (đã sắp xếp) có mặt trong các vị trí dòng rows, không cần cắt DataFrame."""
+    return fidx['ma_categories'][np.unique(fidx['ma_codes'][rows])]
+
+
+def build_ticker_index(df, fidx):
+    """Sắp xếp dữ liệu theo (Mã, Năm, Ngày) một lần để tra lịch sử và bản ghi mới nhất của từng mã."""
+    ma_codes = fidx['ma_codes']
+    years = fidx['years'] if fidx['years'] is not None else np.zeros(len(df))
+    dates = df['Ngày báo cáo'].to_numpy() if 'Ngày báo cáo' in df.columns else np.zeros(len(df))
+    order = np.lexsort((dates, years, ma_codes))
+    n_ma = len(fidx['ma_pos'])
+    starts = np.searchsorted(ma_codes[order], np.arange(n_ma + 1))
+
+    # Bảng [mã x năm]: vị trí dòng mới nhất có Năm <= năm đó (để tra theo giai đoạn đã chọn)
+    upto_pos = upto_year = None
+    if fidx['year_range'] is not None:
+        y_min, y_max = fidx['year_range']
+        sorted_years = years[order]
+        valid = (ma_codes[order] < n_ma) & ~np.isnan(sorted_years)
+        rows, yrs = order[valid], sorted_years[valid].astype(int)
+        last_pos = np.full((n_ma, y_max - y_min + 1), -1, dtype=np.int64)
+        last_pos[ma_codes[rows], yrs - y_min] = rows  # thứ tự đã sắp xếp -> dòng sau cùng ghi đè
+        filled = np.where(last_pos >= 0, np.arange(last_pos.shape[1]), 0)
+        np.maximum.accumulate(filled, axis=1, out=filled)
+        upto_pos = np.take_along_axis(last_pos, filled, axis=1)
+        upto_year = np.where(upto_pos >= 0, filled + y_min, -1)
+    return {'order': order, 'starts': starts, 'upto_pos': upto_pos, 'upto_year': upto_year}
+
+
+def ticker_history(df, fidx, tidx, ma):
+    """Toàn bộ lịch sử của một mã, đã sắp xếp theo thời gian."""
+    code = fidx['ma_pos'].get(ma)
+    if code is None:
+        return df.iloc[:0]
+    return df.iloc[tidx['order'][tidx['starts'][code]:tidx['starts'][code + 1]]]
+
+
+def latest_record(df, fidx, tidx, ma, year_range=None):
+    """Bản ghi mới nhất của một mã (trong giai đoạn year_range nếu có), None nếu không có dữ liệu."""
+    code = fidx['ma_pos'].get(ma)
+    if code is None:
+        return None
+    if year_range is None or tidx['upto_pos'] is None:
+        end = tidx['starts'][code + 1]
+        return df.iloc[tidx['order'][end - 1]] if end > tidx['starts'][code] else None
+
+    y_min, y_max = fidx['year_range']
+    col = min(year_range[1], y_max) - y_min
+    if col < 0 or tidx['upto_year'][code, col] < year_range[0]:
+        return None
+    return df.iloc[tidx['upto_pos'][code, col]]
+
+
+def latest_positions(fidx, tidx, year_range=None):
+    """Vị trí dòng mới nhất của mọi mã (theo thứ tự mã trong chỉ mục), -1 nếu mã không có dữ liệu."""
+    n_ma = len(fidx['ma_pos'])
+    if year_range is None or tidx['upto_pos'] is None:
+        starts, ends = tidx['starts'][:-1], tidx['starts'][1:]
+        last = tidx['order'][np.maximum(ends - 1, 0)] if len(tidx['order']) else np.zeros(n_ma, dtype=np.int64)
+        return np.where(ends > starts, last, -1)
+
+    y_min, y_max = fidx['year_range']
+    col = min(year_range[1], y_max) - y_min
+    if col < 0:
+        return np.full(n_ma, -1, dtype=np.int64)
+    return np.where(tidx['upto_year'][:, col] >= year_range[0], tidx['upto_pos'][:, col], -1)
+
+
+# 3. TẦNG TỔNG HỢP
+def overview_aggregates(df_f):
+    """Ma trận heatmap Mã x Năm cho trang Tổng quan."""
+    return df_f.pivot_table(index='Mã doanh nghiệp', columns='Năm', values='Điểm rủi ro', aggfunc='mean',
+                             observed=True)
+
+
+def strategy_aggregates(df_f, top_n=5):
+    """KPI (số mã, điểm trung bình, độ lệch chuẩn), điểm theo ngành, cơ cấu trạng thái và bảng xếp hạng cho trang
+    Chiến lược; số mã báo động không tính ở đây mà lấy từ bảng cảnh báo (alert_rows)."""
+    score = df_f['Điểm rủi ro']
+    ranking_df = df_f.groupby(['Mã doanh nghiệp', 'Trạng thái'], observed=True)['Điểm rủi ro'].mean().reset_index()
+    return {
+        'n_dn': df_f['Mã doanh nghiệp'].nunique(),
+        'mean': score.mean(),
+        'std': score.std(),
+        'by_industry': df_f.groupby('Ngành nghề', observed=True)['Điểm rủi ro'].mean().reset_index()
+                            .sort_values('Điểm rủi ro'),
+        'status_counts': df_f['Trạng thái'].value_counts(sort=False).loc[lambda c: c > 0].reset_index(),
+        'top_risk': ranking_df.nlargest(top_n, 'Điểm rủi ro'),
+        'top_safe': ranking_df.nsmallest(top_n, 'Điểm rủi ro'),
+    }
+
+
+# 4. MÔ PHỎNG STRESS-TEST
+STRESS_ROA_COEF = 2.0
+STRESS_DEBT_COEF = 0.8
+STATUS_BINS = [40, 70]  # Ngưỡng XANH | VÀNG | ĐỎ theo điểm rủi ro
+STATUS_LABELS = ['AN TOÀN XANH', 'CẢNH BÁO VÀNG', 'BÁO ĐỘNG ĐỎ']
+
+
+def stress_scores(base, roa_shocks, debt_shocks):
+    """Điểm rủi ro sau cú sốc cho mọi (mã, kịch bản) cùng lúc: mảng [mã x ROA x Nợ], giới hạn trong [0, 100]."""
+    base = np.asarray(base, dtype='float64')[:, None, None]
+    roa = np.asarray(roa_shocks, dtype='float64')[None, :, None]
+    debt = np.asarray(debt_shocks, dtype='float64')[None, None, :]
+    return np.clip(base - roa * STRESS_ROA_COEF + debt * STRESS_DEBT_COEF, 0, 100)
+
+
+def status_codes(scores):
+    """0 = XANH, 1 = VÀNG, 2 = ĐỎ."""
+    return np.digitize(scores, STATUS_BINS)
+
+
+def status_transitions(base, scores):
+    """Đếm chuyển trạng thái gốc -> sau sốc cho từng kịch bản: mảng [kịch bản x 3 x 3]."""
+    n = len(STATUS_LABELS)
+    flat = scores.reshape(len(base), -1)
+    codes = status_codes(base)[:, None] * n + status_codes(flat)
+    offsets = np.arange(flat.shape[1]) * n * n
+    counts = np.bincount((codes + offsets).ravel(), minlength=flat.shape[1] * n * n)
+    return counts.reshape(flat.shape[1], n, n)
+
+
+# --- Chấm điểm lại bằng các biến đầu vào của mô hình ---
+# Mỗi biến: (độ co giãn theo lợi nhuận, độ co giãn theo nợ); x_mới = x + |x| * ((1+lợi nhuận)^a * (1+nợ)^b - 1)
+MODEL_FEATURES = {
+    'roa_tre1': (1, 0), 'roe_tre1': (1, 0),
+    'tt_hien_han_tre1': (0, -1), 'tt_nhanh_tre1': (0, -1),
+    'no_tong_tai_san_tre1': (0, 1), 'no_von_chu_so_huu_tre1': (0, 1),
+    'kha_nang_tra_lai_tre1': (1, -1), 'dong_tien_tren_no_tre1': (0, -1),
+    'quy_mo_dn_tre1': (0, 0),
+}
+SURROGATE_CLIP_PCT = (1, 99)
+SURROGATE_RIDGE = 0.25  # hệ số ridge / số dòng: co hệ số khi các tỷ số tương quan mạnh
+SURROGATE_ITERS = 200
+# Ở chế độ mô hình, cú sốc là % thay đổi tương đối của các tỷ số (không phải điểm như công thức tuyến tính):
+# ±10% ROA chỉ dịch điểm rất ít nên thanh trượt dùng dải rộng hơn, bước thô hơn để lưới không quá lớn
+MODEL_SHOCK_LIMIT = 50.0
+MODEL_SHOCK_STEP = 5.0
+PROB_EPS = 1e-6
+
+
+def expected_signs():
+    """Dấu kỳ vọng của hệ số logit theo từng biến: cú sốc tăng nợ / giảm lợi nhuận phải làm rủi ro tăng.
+
+    Với độ co giãn (a, b): dấu = sign(b - a) -> +1 (biến xấu đi khi nợ tăng), -1 (biến tốt lên khi lợi nhuận
+    tăng hoặc xấu đi khi nợ tăng), 0 = không ràng buộc (biến không chịu sốc, vd. quy mô).
+    """
+    return np.sign([b - a for a, b in MODEL_FEATURES.values()])
+
+
+def _sign_constrained_ridge(Z, y, signs, ridge):
+    """Ridge với ràng buộc dấu (coordinate descent có chiếu): w_j * signs_j >= 0 với mọi biến có dấu."""
+    G = Z.T @ Z + ridge * np.eye(Z.shape[1])
+    c = Z.T @ y
+    w = np.zeros(Z.shape[1])
+    for _ in range(SURROGATE_ITERS):
+        prev = w.copy()
+        for j in range(len(w)):
+            w[j] = (c[j] - G[j] @ w + G[j, j] * w[j]) / G[j, j]
+            if signs[j] != 0 and w[j] * signs[j] < 0:
+                w[j] = 0.0  # hệ số ngược dấu kỳ vọng -> loại biến
+        if np.abs(w - prev).max() < 1e-10:
+            break
+    return w
+
+
+def build_scoring_engine(df):
+    """Mô hình thay thế (ridge ràng buộc dấu trên logit xac_suat) + baseline chưa sốc; None nếu thiếu cột."""
+    features = list(MODEL_FEATURES)
+    if 'xac_suat' not in df.columns or any(f not in df.columns for f in features):
+        return None
+    X = np.ascontiguousarray(df[features].to_numpy(dtype='float64'))
+    X = np.where(np.isnan(X), np.nanmedian(X, axis=0), X)
+    lo, hi = np.percentile(X, SURROGATE_CLIP_PCT, axis=0)
+    Xc = np.clip(X, lo, hi)
+    mu, sd = Xc.mean(axis=0), Xc.std(axis=0)
+    sd[sd == 0] = 1.0
+    Z = (Xc - mu) / sd
+
+    p = np.clip(df['xac_suat'].to_numpy(dtype='float64'), PROB_EPS, 1 - PROB_EPS)
+    base_logit = np.log(p / (1 - p))
+    y = base_logit - base_logit.mean()
+    signs = expected_signs()
+    w = _sign_constrained_ridge(Z, y, signs, SURROGATE_RIDGE * len(Z))
+    resid = y - Z @ w
+    return {
+        'features': features,
+        'X': X, 'Xc': Xc, 'lo': lo, 'hi': hi,
+        'coef': w / sd,  # hệ số trên thang gốc (sau khi cắt ngoại lai)
+        'elasticity': np.array([MODEL_FEATURES[f] for f in features], dtype='float64'),
+        'base_logit': base_logit,
+        'r2': float(1 - resid.var() / y.var()) if y.var() > 0 else float('nan'),
+        'active': w != 0,  # biến còn lại sau ràng buộc dấu (độ phủ của mô hình thay thế)
+    }
+
+
+def model_stress_scores(engine, rows, roa_shocks, debt_shocks):
+    """Sốc các biến đầu vào của các dòng `rows` và chấm lại: mảng [dòng x ROA x Nợ] điểm 0-100.
+
+    Chênh lệch logit của mô hình thay thế được cộng vào xác suất thực của mô hình gốc,
+    nên kịch bản (0, 0) trả về đúng điểm rủi ro hiện có.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    growth_roa = 1 + np.asarray(roa_shocks, dtype='float64')[None, :, None] / 100
+    growth_debt = 1 + np.asarray(debt_shocks, dtype='float64')[None, None, :] / 100
+    logit = np.broadcast_to(engine['base_logit'][rows][:, None, None],
+                            (len(rows), growth_roa.shape[1], growth_debt.shape[2])).copy()
+    # Lặp theo biến (9 biến), vector hóa theo dòng x kịch bản để giới hạn bộ nhớ tạm
+    for k in range(len(engine['features'])):
+        a, b = engine['elasticity'][k]
+        if engine['coef'][k] == 0 or (a == 0 and b == 0):
+            continue
+        x = engine['X'][rows, k][:, None, None]
+        shocked = np.clip(x + np.abs(x) * (growth_roa ** a * growth_debt ** b - 1),
+                          engine['lo'][k], engine['hi'][k])
+        logit += engine['coef'][k] * (shocked - engine['Xc'][rows, k][:, None, None])
+    return 100 / (1 + np.exp(-logit))
+
+
+# 5. NHẬN DIỆN MÃ / TÊN CÔNG TY CHO CHATBOT
+# Mã trùng với từ thông dụng (tiếng Anh / tiếng Việt gõ không dấu): chỉ nhận khi người dùng viết HOA
+AMBIGUOUS_TICKERS = {'CAN', 'CAR', 'CEO', 'COM', 'NET', 'ONE', 'PEN', 'PET', 'SHE', 'API', 'MED', 'TIP',
+                     'TOT', 'TRA', 'SAO', 'HOM', 'PAN', 'POT', 'SAM', 'TET', 'DAT', 'HAD', 'HAS', 'HAT', 'INN'}
+# Tiền tố pháp lý / loại hình, bóc lặp lại: "CTCP Tập đoàn Đầu tư X" -> "Tập đoàn Đầu tư X" -> "Đầu tư X" -> "X"
+LEGAL_PREFIXES = [('CONG', 'TY', 'CO', 'PHAN'), ('TONG', 'CONG', 'TY'), ('CONG', 'TY'), ('CO', 'PHAN'),
+                  ('TAP', 'DOAN'), ('DAU', 'TU'), ('CTCP',)]
+MIN_SINGLE_ALIAS_LEN = 5
+
+
+def _fold(text):
+    """Bỏ dấu tiếng Việt và viết hoa để so khớp tên công ty."""
+    text = unicodedata.normalize('NFD', str(text).replace('đ', 'd').replace('Đ', 'D'))
+    return ''.join(c for c in text if not unicodedata.combining(c)).upper()
+
+
+def _tokens(text):
+    return re.findall(r'[^\W_]+', text)
+
+
+def build_ticker_matcher(df):
+    """Tập mã + từ điển bí danh tên công ty (chuỗi token không dấu -> mã), dựng một lần khi load."""
+    names = df.drop_duplicates('Mã doanh nghiệp')[['Mã doanh nghiệp', 'Tên công ty']] \
+        if 'Tên công ty' in df.columns else pd.DataFrame(columns=['Mã doanh nghiệp', 'Tên công ty'])
+    candidates = {}
+    for ma, name in zip(names['Mã doanh nghiệp'].astype(str), names['Tên công ty'].astype(str)):
+        aliases = {tuple(_tokens(_fold(a))) for a in re.findall(r'\(([^)]*)\)', name)}
+        full = tuple(_tokens(_fold(re.sub(r'\([^)]*\)', ' ', name))))
+        aliases.add(full)
+        stripped = full
+        while True:
+            prefix = next((p for p in LEGAL_PREFIXES if stripped[:len(p)] == p), None)
+            if prefix is None:
+                break
+            stripped = stripped[len(prefix):]
+            aliases.add(stripped)
+        for alias in aliases:
+            if len(alias) > 1 or (len(alias) == 1 and len(alias[0]) >= MIN_SINGLE_ALIAS_LEN):
+                candidates.setdefault(alias, set()).add(ma)
+    # Bí danh trùng giữa nhiều công ty thì bỏ, tránh trả lời nhầm mã
+    aliases = {alias: next(iter(mas)) for alias, mas in candidates.items() if len(mas) == 1}
+    return {
+        'tickers': set(names['Mã doanh nghiệp'].astype(str)),
+        'aliases': aliases,
+        'max_len': max(map(len, aliases), default=0),
+    }
+
+
+def match_tickers(matcher, text):
+    """Các mã được nhắc tới trong câu (theo thứ tự xuất hiện, không trùng lặp)."""
+    raw = _tokens(text)
+    folded = [_fold(t) for t in raw]
+    found, i = [], 0
+    while i < len(raw):
+        hit, step = None, 1
+        for n in range(min(matcher['max_len'], len(raw) - i), 0, -1):
+            alias = tuple(folded[i:i + n])
+            if alias in matcher['aliases']:
+                hit, step = matcher['aliases'][alias], n
+                break
+        tok = raw[i].upper()
+        if hit is None and tok in matcher['tickers'] and (raw[i].isupper() or tok not in AMBIGUOUS_TICKERS):
+            hit = tok
+        if hit is not None and hit not in found:
+            found.append(hit)
+        i += step
+    return found
+
+
+# --- Lịch sử chat có giới hạn: gộp các tin cũ thành một tin tóm tắt ---
+CHAT_HISTORY_LIMIT = 40  # Vượt quá số tin này thì thu gọn
+CHAT_KEEP_RECENT = 20    # Số tin gần nhất giữ nguyên văn sau khi thu gọn
+
+
+def compact_chat(messages, matcher, limit=CHAT_HISTORY_LIMIT, keep=CHAT_KEEP_RECENT):
+    """Giữ `keep` tin gần nhất, các tin cũ hơn gộp vào một tin tóm tắt (số tin + các mã đã hỏi)."""
+    if len(messages) <= limit:
+        return messages
+    old, recent = messages[:-keep], messages[-keep:]
+    n_old, tickers = 0, []
+    for m in old:
+        if m.get('compacted'):
+            n_old += m['compacted']
+            tickers += m.get('tickers', [])
+            continue
+        n_old += 1
+        if m['role'] == 'user':
+            tickers += match_tickers(matcher, m['content'])
+    tickers = list(dict.fromkeys(tickers))
+    content = f"🗂️ *Đã thu gọn {n_old} tin nhắn cũ.*"
+    if tickers:
+        content += f" Các mã đã hỏi: {', '.join(tickers)}."
+    return [{'role': 'assistant', 'content': content, 'compacted': n_old, 'tickers': tickers}] + recent
+
+
+# 6. CẢNH BÁO SỚM
+# Ngưỡng cảnh báo dùng chung cho banner, KPI, trang Cẩm nang và chatbot (chỉnh được ở sidebar)
+ALERT_RULES = {
+    'score_threshold': 70.0,   # điểm rủi ro >= ngưỡng -> vượt ngưỡng (trùng mốc BÁO ĐỘNG ĐỎ)
+    'jump_threshold': 15.0,    # điểm tăng >= mức này so với kỳ trước của cùng mã
+    'ratio_worsen_pct': 30.0,  # tỷ số tài chính xấu đi >= % so với kỳ trước (cột *_tre1)
+    'min_ratio_signals': 4,    # số tỷ số xấu đi tối thiểu để bật cảnh báo
+}
+# Tỷ số được so với cột trễ *_tre1: +1 = càng cao càng tốt, -1 = càng cao càng xấu
+ALERT_RATIOS = {
+    'roa': 1, 'roe': 1, 'tt_hien_han': 1, 'tt_nhanh': 1, 'kha_nang_tra_lai': 1, 'dong_tien_tren_no': 1,
+    'quy_mo_dn': 1, 'no_tong_tai_san': -1, 'no_von_chu_so_huu': -1,
+}
+ALERT_LABELS = {
+    'breach': "Vượt ngưỡng điểm",
+    'jump': "Điểm tăng đột biến",
+    'downgrade': "Hạ bậc trạng thái",
+    'ratio_worse': "Tỷ số tài chính xấu đi",
+}
+
+
+def build_alerts(df, fidx, tidx, score_threshold=ALERT_RULES['score_threshold'],
+                 jump_threshold=ALERT_RULES['jump_threshold'], ratio_worsen_pct=ALERT_RULES['ratio_worsen_pct'],
+                 min_ratio_signals=ALERT_RULES['min_ratio_signals']):
+    """Quét toàn bộ dữ liệu một lần (vector hóa): cờ cảnh báo theo từng dòng và bảng các dòng có cảnh báo."""
+    n = len(df)
+    score = df['Điểm rủi ro'].to_numpy(dtype=np.float64)
+    order, ma_codes = tidx['order'], fidx['ma_codes']
+
+    # Kỳ trước của cùng mã: dòng liền trước trong thứ tự (Mã, Năm, Ngày) đã sắp xếp sẵn
+    prev = np.full(n, -1, dtype=np.int64)
+    if n > 1:
+        same = ma_codes[order[1:]] == ma_codes[order[:-1]]
+        prev[order[1:][same]] = order[:-1][same]
+    has_prev = prev >= 0
+    prev_score = np.where(has_prev, score[np.maximum(prev, 0)], np.nan)
+    delta = score - prev_score
+
+    level = status_codes(score)
+    breach = score >= score_threshold
+    jump = has_prev & (delta >= jump_threshold)
+    downgrade = has_prev & (level > np.where(has_prev, level[np.maximum(prev, 0)], 0))
+
+    n_worse = np.zeros(n, dtype=np.int8)
+    for col, sign in ALERT_RATIOS.items():
+        if col not in df.columns or f'{col}_tre1' not in df.columns:
+            continue
+        cur = df[col].to_numpy(dtype=np.float64)
+        lag = df[f'{col}_tre1'].to_numpy(dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = sign * (cur - lag) / np.abs(lag) * 100
+        n_worse += np.nan_to_num(change <= -ratio_worsen_pct, nan=False).astype(np.int8)
+    ratio_worse = n_worse >= min_ratio_signals
+
+    flags = {'breach': breach, 'jump': jump, 'downgrade': downgrade, 'ratio_worse': ratio_worse}
+    rows = np.flatnonzero(breach | jump | downgrade | ratio_worse)
+    table = pd.DataFrame({
+        'Mã doanh nghiệp': df['Mã doanh nghiệp'].to_numpy()[rows],
+        'Năm': df['Năm'].to_numpy()[rows] if 'Năm' in df.columns else np.nan,
+        'Điểm rủi ro': score[rows],
+        'Thay đổi': delta[rows],
+        'Tỷ số xấu đi': n_worse[rows],
+        'Cảnh báo': [", ".join(ALERT_LABELS[k] for k in flags if flags[k][r]) for r in rows],
+    }, index=pd.Index(rows, name='row'))
+    return {**flags, 'n_worse': n_worse, 'delta': delta, 'prev_score': prev_score, 'level': level,
+            'rows': rows, 'table': table}
+
+
+def alert_rows(alerts, rows, kinds=('breach',)):
+    """Lọc các vị trí dòng (vd. kết quả select_rows) có ít nhất một loại cảnh báo trong kinds."""
+    rows = np.asarray(rows, dtype=np.int64)
+    hit = np.zeros(len(rows), dtype=bool)
+    for k in kinds:
+        hit |= alerts[k][rows]
+    return rows[hit]
+
+
+def alert_labels(alerts, row):
+    """Danh sách tên cảnh báo đang bật tại một dòng (dùng cho chatbot)."""
+    return [label for k, label in ALERT_LABELS.items() if alerts[k][row]]
+
+
+# 7. TÌM DOANH NGHIỆP TƯƠNG ĐỒNG
+PEER_FEATURES = ['roa', 'roe', 'no_tong_tai_san', 'tt_hien_han', 'tt_nhanh', 'kha_nang_tra_lai',
+                 'dong_tien_tren_no', 'quy_mo_dn']
+PEER_CLIP_PCT = (1, 99)  # cắt đuôi trước khi chuẩn hóa: vài giá trị cực đoan (roe ~ 278) không lấn át khoảng cách
+PEER_METRICS = ('cosine', 'euclidean')
+PEER_OVERSAMPLE = 20  # lấy trước k * hệ số này ứng viên rồi mới lọc trùng mã, tránh sắp xếp toàn bộ
+
+
+def build_peer_index(df, fidx):
+    """Ma trận tỷ số tài chính đã chuẩn hóa (float32, liền bộ nhớ) cho mọi dòng Mã x Năm."""
+    cols = [c for c in PEER_FEATURES if c in df.columns]
+    if not cols:
+        return None
+    X = df[cols].to_numpy(dtype=np.float64)
+    lo, hi = np.nanpercentile(X, PEER_CLIP_PCT, axis=0)
+    X = np.clip(X, lo, hi)
+    mean, std = np.nanmean(X, axis=0), np.nanstd(X, axis=0)
+    X = np.nan_to_num((X - mean) / np.where(std > 0, std, 1.0))  # thiếu dữ liệu = giá trị trung bình
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1)
+    return {
+        'features': cols,
+        'X': X,
+        'sq_norms': norms ** 2,
+        'unit': np.ascontiguousarray(X / np.where(norms > 0, norms, 1.0)[:, None], dtype=np.float32),
+        'ma_codes': fidx['ma_codes'],
+        'nganh_codes': fidx['nganh_codes'],
+        'years': fidx['years'],
+    }
+
+
+def find_peers(pidx, row, k=5, metric='cosine', same_industry=False, same_year=False):
+    """Top-k dòng (mỗi mã một dòng gần nhất, khác mã của dòng truy vấn) tương đồng với dòng row.
+
+    Trả về (vị trí dòng, điểm): độ tương đồng cosine (cao = giống) hoặc khoảng cách Euclid (thấp = giống).
+    """
+    if metric == 'cosine':
+        score = pidx['unit'] @ pidx['unit'][row]
+    else:
+        # |a - b|^2 = |a|^2 + |b|^2 - 2ab: một phép nhân ma trận-vector thay vì tạo ma trận hiệu
+        score = -np.sqrt(np.maximum(pidx['sq_norms'] + pidx['sq_norms'][row] - 2 * (pidx['X'] @ pidx['X'][row]), 0))
+
+    ma_codes = pidx['ma_codes']
+    valid = ma_codes != ma_codes[row]
+    if same_industry:
+        valid &= pidx['nganh_codes'] == pidx['nganh_codes'][row]
+    if same_year and pidx['years'] is not None:
+        valid &= pidx['years'] == pidx['years'][row]
+    cand = np.flatnonzero(valid)
+    if len(cand) == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+    # Nhóm đầu k * PEER_OVERSAMPLE ứng viên thường đủ k mã khác nhau; nếu không mới sắp xếp toàn bộ
+    for size in (min(len(cand), k * PEER_OVERSAMPLE), len(cand)):
+        part = cand[np.argpartition(-score[cand], size - 1)[:size]] if size < len(cand) else cand
+        part = part[np.argsort(-score[part], kind='stable')]
+        _, first = np.unique(ma_codes[part], return_index=True)  # dòng gần nhất của từng mã
+        best = part[np.sort(first)][:k]
+        if len(best) == k:
+            break
+    return best, (score[best] if metric == 'cosine' else -score[best])
+
+
+# 8. ĐIỂM RADAR SỨC KHỎE TÀI CHÍNH
+RADAR_AXES = ['Độ An toàn (100-Risk)', 'Thanh khoản', 'Cấu trúc Vốn (Ít nợ)', 'Sinh lời (ROA)', 'Dòng tiền']
+
+
+def radar_frame(df_rows):
+    """Quy đổi các dòng về thang 0-100 theo các trục RADAR_AXES (bảng xuất file / báo cáo, radar từng mã).
+
+    Thiếu cột thì dùng giá trị mặc định; tỷ số NaN bị chặn về trần 100 (fmin/fmax bỏ qua NaN).
+    """
+    def col(name, default):
+        return df_rows[name].to_numpy(dtype=np.float64) if name in df_rows.columns else np.full(len(df_rows), default)
+
+    val_cash = col('dong_tien_tren_no_tre1', 0)
+    return pd.DataFrame(np.column_stack([
+        100 - df_rows['Điểm rủi ro'].to_numpy(dtype=np.float64),
+        np.fmin(100, col('tt_hien_han_tre1', 0) * 50),
+        np.fmax(0, np.fmin(100, (1 - col('no_tong_tai_san_tre1', 0.5)) * 100)),
+        np.fmax(0, np.fmin(100, col('roa_tre1', 0) * 500)),
+        np.select([val_cash > 0.5, val_cash > 0, val_cash == 0], [100, 70, 50], 20),
+    ]), columns=RADAR_AXES, index=df_rows.index)
+
+
+def radar_scores(rec):
+    """Điểm radar của một bản ghi (mã chính và mã tương đồng), cùng công thức với radar_frame."""
+    return radar_frame(rec.to_frame().T).iloc[0].tolist()
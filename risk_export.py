@@ -0,0 +1,244 @@
+"""Xuất dữ liệu đã lọc ra file và dựng báo cáo HTML nhiều mã (không phụ thuộc Streamlit).
+
+code_app.py gọi các hàm ở đây từ trang "Xuất báo cáo"; biểu đồ của từng mã x năm được dựng song song trong
+một pool luồng và giữ lại trong FigureCache để lần xuất sau (danh mục trùng một phần) không phải vẽ lại.
+"""
+import html
+import io
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from plotly.offline import get_plotlyjs
+
+import risk_core as core
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Không có pyarrow -> không xuất Parquet
+    pa = pq = None
+
+
+# 1. XUẤT FILE THEO TỪNG KHỐI
+EXPORT_CHUNK_ROWS = 50_000  # Mỗi lần chỉ cắt/ghi từng khối dòng, không dựng cả bảng trong bộ nhớ
+EXCEL_MAX_ROWS = 1_048_575  # Giới hạn dòng dữ liệu của một sheet Excel (trừ dòng tiêu đề)
+EXPORT_FORMATS = {
+    'CSV': ('csv', 'text/csv'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+    'Excel (XLSX)': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+def _excel_engine():
+    # openpyxl được khai báo trong requirements.txt; xlsxwriter (nếu có) ghi nhanh hơn nên ưu tiên.
+    # Kiểm tra lúc chạy chỉ là dự phòng cho môi trường cài thiếu thư viện.
+    for engine in ('xlsxwriter', 'openpyxl'):
+        try:
+            __import__(engine)
+            return engine
+        except ImportError:
+            continue
+    return None
+
+
+def available_formats():
+    """Các định dạng xuất dùng được với thư viện đang cài (CSV luôn có)."""
+    formats = ['CSV']
+    if pq is not None:
+        formats.append('Parquet')
+    if _excel_engine() is not None:
+        formats.append('Excel (XLSX)')
+    return formats
+
+
+def iter_chunks(df, rows, columns=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Cắt df theo vị trí dòng rows thành từng khối (mỗi khối là một bản sao nhỏ, dùng xong là bỏ)."""
+    cols = df.columns if columns is None else columns
+    for start in range(0, len(rows), chunk_rows):
+        yield df.iloc[rows[start:start + chunk_rows]][cols]
+
+
+def write_chunks(chunks, fmt, fh):
+    """Ghi lần lượt các khối DataFrame vào file nhị phân fh theo định dạng fmt (khóa của EXPORT_FORMATS)."""
+    if fmt == 'CSV':
+        first = True
+        for chunk in chunks:
+            # BOM ở đầu file để Excel đọc đúng tiếng Việt
+            fh.write(chunk.to_csv(index=False, header=first).encode('utf-8-sig' if first else 'utf-8'))
+            first = False
+    elif fmt == 'Parquet':
+        if pq is None:
+            raise ValueError("Cần cài pyarrow để xuất Parquet.")
+        writer = None
+        try:
+            for chunk in chunks:
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(fh, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                writer.write_table(table)  # mỗi khối là một row group
+        finally:
+            if writer is not None:
+                writer.close()
+    elif fmt == 'Excel (XLSX)':
+        engine = _excel_engine()
+        if engine is None:
+            raise ValueError("Cần cài xlsxwriter hoặc openpyxl để xuất Excel.")
+        with pd.ExcelWriter(fh, engine=engine) as writer:
+            sheet, row = 1, 0
+            for chunk in chunks:
+                while len(chunk):
+                    part, chunk = chunk.iloc[:EXCEL_MAX_ROWS - row], chunk.iloc[EXCEL_MAX_ROWS - row:]
+                    part.to_excel(writer, sheet_name=f"Du lieu {sheet}", index=False, header=row == 0,
+                                  startrow=row + (row > 0))
+                    row += len(part)
+                    if row >= EXCEL_MAX_ROWS:
+                        sheet, row = sheet + 1, 0
+    else:
+        raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+
+
+def export_file(chunks, fmt):
+    """Nội dung file xuất (bytes); chỉ một khối dữ liệu được cắt ra tại mỗi thời điểm."""
+    fh = io.BytesIO()
+    write_chunks(chunks, fmt, fh)
+    return fh.getvalue()
+
+
+# 2. BẢNG DÙNG CHO XUẤT FILE VÀ BÁO CÁO
+def snapshot_table(df, fidx, tidx, rows, year_range=None, alerts=None):
+    """Bản ghi mới nhất (trong giai đoạn) của từng mã có trong rows, kèm điểm radar và cảnh báo."""
+    codes = np.unique(fidx['ma_codes'][rows])
+    pos = core.latest_positions(fidx, tidx, year_range)[codes]
+    pos = pos[pos >= 0]
+    cols = [c for c in ['Mã doanh nghiệp', 'Tên công ty', 'Ngành nghề', 'Năm', 'Điểm rủi ro', 'Trạng thái',
+                        'xac_suat'] if c in df.columns]
+    snap = df.iloc[pos][cols]
+    snap = pd.concat([snap, core.radar_frame(df.iloc[pos]).round(1)], axis=1)
+    if alerts is not None:
+        snap['Cảnh báo'] = [", ".join(core.alert_labels(alerts, p)) for p in pos]
+    return snap.sort_values('Điểm rủi ro', ascending=False).reset_index(drop=True)
+
+
+# 3. BÁO CÁO HTML NHIỀU MÃ
+REPORT_MAX_TICKERS = 100  # Báo cáo chi tiết tối đa chừng này mã rủi ro cao nhất
+REPORT_WORKERS = 4
+FIGURE_CACHE_ENTRIES = 1024
+STATUS_FILL = {'AN TOÀN XANH': 'rgba(46, 204, 113, 0.5)', 'CẢNH BÁO VÀNG': 'rgba(241, 196, 15, 0.5)',
+               'BÁO ĐỘNG ĐỎ': 'rgba(231, 76, 60, 0.5)'}
+STATUS_LINE = {'AN TOÀN XANH': '#27ae60', 'CẢNH BÁO VÀNG': '#f39c12', 'BÁO ĐỘNG ĐỎ': '#c0392b'}
+REPORT_CSS = """
+body { font-family: 'Segoe UI', sans-serif; margin: 24px; color: #2c3e50; }
+table { border-collapse: collapse; font-size: 12px; margin-bottom: 16px; }
+th, td { border: 1px solid #e0e0e0; padding: 4px 8px; text-align: right; }
+th { background: #f0f2f6; }
+.card { page-break-inside: avoid; border-top: 2px solid #e0e0e0; padding-top: 8px; }
+.figs { display: flex; gap: 8px; }
+.alert { color: #c0392b; font-weight: bold; }
+"""
+
+
+class FigureCache:
+    """LRU các đoạn HTML biểu đồ đã dựng, dùng chung giữa các lần xuất (an toàn đa luồng)."""
+
+    def __init__(self, max_entries=FIGURE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+        value = render()  # dựng ngoài khóa để các luồng khác không phải chờ
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+        return value
+
+
+def _fig_html(fig):
+    return fig.to_html(full_html=False, include_plotlyjs=False, config={'displayModeBar': False})
+
+
+def render_ticker_figures(history, rec):
+    """Radar của kỳ được chọn + đường điểm rủi ro toàn bộ lịch sử của một mã (HTML, chưa kèm plotly.js)."""
+    radar = go.Figure(go.Scatterpolar(
+        r=core.radar_scores(rec), theta=core.RADAR_AXES, fill='toself',
+        fillcolor=STATUS_FILL.get(rec['Trạng thái'], 'rgba(100, 100, 100, 0.5)'),
+        line=dict(color=STATUS_LINE.get(rec['Trạng thái'], '#7f8c8d'))))
+    radar.update_layout(polar=dict(radialaxis=dict(visible=True, range=[0, 100])), width=420, height=320,
+                        margin=dict(l=40, r=40, t=20, b=20), showlegend=False)
+    trend = px.line(history, x='Năm', y='Điểm rủi ro', markers=True, width=480, height=320)
+    trend.update_layout(margin=dict(l=0, r=0, t=20, b=0), yaxis_range=[0, 100], xaxis_title=None)
+    return _fig_html(radar) + _fig_html(trend)
+
+
+def _ticker_card(rec, figures, alert_text):
+    head = (f"<h3>{html.escape(str(rec['Mã doanh nghiệp']))} - {html.escape(str(rec.get('Tên công ty', '')))}</h3>"
+            f"<p>Ngành: {html.escape(str(rec['Ngành nghề']))} | Năm {rec['Năm']:.0f} | "
+            f"Điểm rủi ro <b>{rec['Điểm rủi ro']:.2f}</b> | {html.escape(str(rec['Trạng thái']))}</p>")
+    if alert_text:
+        head += f"<p class='alert'>🚨 {html.escape(alert_text)}</p>"
+    return f"<div class='card'>{head}<div class='figs'>{figures}</div></div>"
+
+
+def render_report(df, fidx, tidx, rows, pool, fig_cache, year_range=None, alerts=None, title="Báo cáo rủi ro"):
+    """Báo cáo HTML tự chứa (mở offline, in ra PDF từ trình duyệt) cho các mã trong rows.
+
+    Biểu đồ từng mã được dựng song song trong pool, khóa cache theo (phiên bản dữ liệu của mã, mã, năm).
+    """
+    started = time.perf_counter()
+    hits0, misses0 = fig_cache.hits, fig_cache.misses
+    df_f = df.iloc[rows]
+    snap = snapshot_table(df, fidx, tidx, rows, year_range, alerts)
+    agg = core.strategy_aggregates(df_f)
+    heat = core.overview_aggregates(df_f)
+
+    detail = snap.head(REPORT_MAX_TICKERS)
+    futures = []
+    for ma in detail['Mã doanh nghiệp']:
+        rec = core.latest_record(df, fidx, tidx, ma, year_range)
+        key = (core.selection_stamp(df, [ma]), ma, int(rec['Năm']))
+        history = core.ticker_history(df, fidx, tidx, ma)
+        futures.append((rec, pool.submit(fig_cache.get_or_render, key,
+                                         lambda h=history, r=rec: render_ticker_figures(h, r))))
+
+    # Heatmap theo đúng thứ tự các thẻ chi tiết (rủi ro giảm dần), không phải thứ tự mã A-Z của bảng pivot
+    heat_detail = heat.reindex(detail['Mã doanh nghiệp'])
+    heat_fig = px.imshow(heat_detail, color_continuous_scale='RdYlGn_r', aspect='auto',
+                         height=max(300, 18 * len(heat_detail)))
+    heat_title = ("Heatmap Mã x Năm" if len(heat) <= len(heat_detail)
+                  else f"Heatmap Mã x Năm ({len(heat_detail)}/{len(heat)} mã rủi ro cao nhất)")
+    alert_text = dict(zip(snap['Mã doanh nghiệp'], snap['Cảnh báo'])) if 'Cảnh báo' in snap.columns else {}
+    cards = [_ticker_card(rec, fut.result(), alert_text.get(rec['Mã doanh nghiệp'], "")) for rec, fut in futures]
+
+    parts = [
+        f"<h1>{html.escape(title)}</h1>",
+        f"<p>Tạo lúc {time.strftime('%Y-%m-%d %H:%M')} | {agg['n_dn']} mã | {len(rows):,} dòng dữ liệu"
+        + (f" | Giai đoạn {year_range[0]}-{year_range[1]}" if year_range else "") + "</p>",
+        f"<p>Rủi ro TB: <b>{agg['mean']:.2f}</b> | Độ lệch chuẩn: {agg['std']:.2f}</p>",
+        "<h2>Xếp hạng rủi ro</h2>",
+        "<h4>Top rủi ro cao nhất</h4>" + agg['top_risk'].to_html(index=False, float_format="%.2f"),
+        "<h4>Top an toàn nhất</h4>" + agg['top_safe'].to_html(index=False, float_format="%.2f"),
+        f"<h2>{heat_title}</h2>" + _fig_html(heat_fig),
+        "<h2>Ảnh chụp mới nhất theo mã</h2>" + snap.to_html(index=False, float_format="%.2f", na_rep=""),
+        f"<h2>Chi tiết {len(cards)} mã rủi ro cao nhất</h2>" + "".join(cards),
+    ]
+    stats = {'seconds': time.perf_counter() - started, 'tickers': len(cards),
+             'cache_hits': fig_cache.hits - hits0, 'cache_misses': fig_cache.misses - misses0}
+    doc = (f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>{html.escape(title)}</title>"
+           f"<style>{REPORT_CSS}</style><script>{get_plotlyjs()}</script></head><body>"
+           + "".join(parts) + "</body></html>")
+    return doc, stats
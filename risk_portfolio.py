@@ -0,0 +1,162 @@
+"""Rủi ro cấp danh mục đầu tư: điểm/xác suất theo tỷ trọng, mức tập trung ngành, biến động điểm theo năm
+(không phụ thuộc Streamlit).
+
+Danh mục được nối vào dữ liệu qua chỉ mục mã (build_filter_index / build_ticker_index) của risk_core, nên mọi
+phép tính đều là thao tác mảng trên các vị trí dòng, không cần merge lại DataFrame gốc.
+"""
+import hashlib
+import io
+
+import numpy as np
+import pandas as pd
+
+import risk_core as core
+
+
+# 1. ĐỌC FILE DANH MỤC
+TICKER_ALIASES = ['ma_ck', 'ma', 'ticker', 'mã', 'mã doanh nghiệp', 'mã chứng khoán']
+WEIGHT_ALIASES = ['ty_trong', 'trong_so', 'weight', 'tỷ trọng', 'gia_tri', 'value', 'giá trị']
+SAMPLE_HOLDINGS = "ma_ck,ty_trong\nVNM,0.4\nHVN,0.35\nFPT,0.25\n"
+
+
+def upload_types():
+    """Đuôi file danh mục đọc được (XLSX cần openpyxl, đã khai báo trong requirements.txt; kiểm tra để dự phòng)."""
+    try:
+        __import__('openpyxl')
+    except ImportError:
+        return ['csv']
+    return ['csv', 'xlsx']
+
+
+def holdings_hash(raw):
+    """Khóa cache của một file danh mục (nội dung, không phải tên file)."""
+    return hashlib.sha1(raw).hexdigest()
+
+
+def _find_column(columns, aliases):
+    folded = {str(c).strip().lower(): c for c in columns}
+    return next((folded[a] for a in aliases if a in folded), None)
+
+
+def parse_holdings(raw, file_name="holdings.csv"):
+    """Đọc file CSV/XLSX danh mục -> DataFrame ['Mã doanh nghiệp', 'Tỷ trọng'] (tỷ trọng chưa chuẩn hóa).
+
+    Cột mã/tỷ trọng nhận nhiều tên (TICKER_ALIASES / WEIGHT_ALIASES); không có cột tỷ trọng thì chia đều.
+    File phân cách bằng ';' (Excel VN) dùng ',' cho phần thập phân và '.' cho hàng nghìn: 0,4 / 1.500.000.
+    Dòng có tỷ trọng không phải số dương bị bỏ và ghi vào attrs['invalid'] dạng [(mã, giá trị gốc)].
+    """
+    decimal_comma = False
+    if file_name.lower().endswith('.xlsx'):
+        table = pd.read_excel(io.BytesIO(raw))
+    else:
+        header = raw.split(b'\n', 1)[0]
+        sep = next((c for c in (';', '\t') if c.encode() in header), ',')  # file Excel VN hay dùng ';'
+        decimal_comma = sep == ';'
+        number_format = {'decimal': ',', 'thousands': '.'} if decimal_comma else {}
+        table = pd.read_csv(io.BytesIO(raw), sep=sep, encoding='utf-8-sig', **number_format)
+    ma_col = _find_column(table.columns, TICKER_ALIASES)
+    if ma_col is None:
+        raise ValueError(f"Không tìm thấy cột mã chứng khoán (một trong: {', '.join(TICKER_ALIASES)}).")
+    w_col = _find_column(table.columns, WEIGHT_ALIASES)
+    if w_col is None:
+        weights = pd.Series(1.0, index=table.index)
+    elif decimal_comma and not pd.api.types.is_numeric_dtype(table[w_col]):
+        # Cột lẫn giá trị lỗi (vd. "abc") thì read_csv để nguyên chuỗi, bỏ qua decimal/thousands -> tự chuyển
+        weights = pd.to_numeric(table[w_col].astype(str).str.replace('.', '', regex=False)
+                                .str.replace(',', '.', regex=False), errors='coerce')
+    else:
+        weights = pd.to_numeric(table[w_col], errors='coerce')
+    holdings = pd.DataFrame({'Mã doanh nghiệp': table[ma_col].astype(str).str.strip().str.upper(),
+                             'Tỷ trọng': weights.to_numpy(dtype=np.float64)})
+    has_ma = holdings['Mã doanh nghiệp'] != ''
+    valid = has_ma & (holdings['Tỷ trọng'] > 0)
+    raw_weights = table[w_col] if w_col is not None else holdings['Tỷ trọng']
+    invalid = [(ma, str(w) if pd.notna(w) else 'trống')
+               for ma, w in zip(holdings.loc[has_ma & ~valid, 'Mã doanh nghiệp'], raw_weights[has_ma & ~valid])]
+    # Cùng một mã xuất hiện nhiều dòng (nhiều lô) -> cộng dồn
+    holdings = holdings[valid].groupby('Mã doanh nghiệp', sort=False, as_index=False)['Tỷ trọng'].sum()
+    holdings.attrs['invalid'] = invalid
+    return holdings
+
+
+# 2. CHỈ SỐ DANH MỤC
+ROLLING_YEARS = 3  # Cửa sổ (số năm) tính độ lệch chuẩn trượt của điểm rủi ro
+
+
+def _holding_rows(fidx, tidx, codes, year_range):
+    """Vị trí dòng của các mã trong danh mục (theo thứ tự Mã, Năm), lấy thẳng từ chỉ mục mã."""
+    starts, ends = tidx['starts'][codes], tidx['starts'][codes + 1]
+    lengths = ends - starts
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = tidx['order'][np.repeat(starts, lengths) + offsets]
+    if year_range is not None and fidx['years'] is not None:
+        years = fidx['years'][rows]
+        rows = rows[(years >= year_range[0]) & (years <= year_range[1])]
+    return rows
+
+
+def portfolio_metrics(df, fidx, tidx, holdings, year_range=None, window=ROLLING_YEARS):
+    """Điểm rủi ro / xác suất vỡ nợ theo tỷ trọng, tập trung ngành và biến động điểm trượt theo năm."""
+    codes = holdings['Mã doanh nghiệp'].map(fidx['ma_pos'])
+    missing = holdings.loc[codes.isna(), 'Mã doanh nghiệp'].tolist()
+    held = holdings[codes.notna()]
+    codes = codes.dropna().to_numpy(dtype=np.int64)
+
+    # Bản ghi mới nhất trong giai đoạn của từng mã nắm giữ (tra bảng dựng sẵn, không sắp xếp lại)
+    pos = core.latest_positions(fidx, tidx, year_range)[codes]
+    has_data = pos >= 0
+    weights = held['Tỷ trọng'].to_numpy(dtype=np.float64)
+    total_w = weights.sum() + sum(holdings.loc[holdings['Mã doanh nghiệp'].isin(missing), 'Tỷ trọng'])
+    w = np.where(has_data, weights, 0.0)
+    w_norm = w / w.sum() if w.sum() > 0 else w
+
+    latest = df.iloc[pos[has_data]]
+    score = np.full(len(codes), np.nan)
+    score[has_data] = latest['Điểm rủi ro'].to_numpy(dtype=np.float64)
+    prob = np.full(len(codes), np.nan)
+    if 'xac_suat' in df.columns:
+        prob[has_data] = latest['xac_suat'].to_numpy(dtype=np.float64)
+
+    # Chuỗi điểm theo năm (Năm x Mã) -> độ lệch chuẩn trượt cho mọi mã cùng lúc
+    rows = _holding_rows(fidx, tidx, codes, year_range)
+    history = pd.DataFrame({'Năm': fidx['years'][rows], 'code': fidx['ma_codes'][rows],
+                            'score': df['Điểm rủi ro'].to_numpy(dtype=np.float64)[rows]})
+    by_year = history.pivot_table(index='Năm', columns='code', values='score', aggfunc='mean').sort_index()
+    rolling_std = by_year.rolling(window, min_periods=2).std()
+    # Điểm danh mục mỗi năm: trung bình theo tỷ trọng các mã có dữ liệu năm đó
+    year_w = pd.Series(weights, index=codes).reindex(by_year.columns).to_numpy()
+    present = by_year.notna().to_numpy()
+    port_score = (by_year.fillna(0).to_numpy() @ year_w) / np.where(present @ year_w > 0, present @ year_w, np.nan)
+    yearly = pd.DataFrame({'Điểm danh mục': port_score}, index=by_year.index)
+    yearly['Biến động danh mục'] = yearly['Điểm danh mục'].rolling(window, min_periods=2).std()
+    last_vol = rolling_std.ffill().iloc[-1] if len(rolling_std) else pd.Series(dtype=np.float64)
+
+    table = pd.DataFrame({
+        'Mã doanh nghiệp': held['Mã doanh nghiệp'].to_numpy(),
+        'Tên công ty': df['Tên công ty'].to_numpy()[np.maximum(pos, 0)] if 'Tên công ty' in df.columns else '',
+        'Ngành nghề': np.asarray(df['Ngành nghề'].to_numpy()[np.maximum(pos, 0)], dtype=object),
+        'Tỷ trọng': weights / total_w if total_w > 0 else weights,
+        'Năm': np.where(has_data, fidx['years'][np.maximum(pos, 0)] if fidx['years'] is not None else np.nan,
+                        np.nan),
+        'Điểm rủi ro': score,
+        'xac_suat': prob,
+        f'Biến động {window} năm': last_vol.reindex(codes).to_numpy(),
+        'Đóng góp rủi ro': w_norm * np.nan_to_num(score) / max(np.nansum(w_norm * score), 1e-12),
+    })
+    table.loc[~has_data, ['Tên công ty', 'Ngành nghề']] = None
+
+    by_industry = (table[has_data].assign(**{'Tỷ trọng': w_norm[has_data]})
+                   .groupby('Ngành nghề', observed=True)['Tỷ trọng'].sum().sort_values(ascending=False))
+    hhi = float((by_industry ** 2).sum())
+    return {
+        'table': table.sort_values('Tỷ trọng', ascending=False).reset_index(drop=True),
+        'weighted_score': float(np.nansum(w_norm * score)) if has_data.any() else np.nan,
+        'weighted_prob': float(np.nansum(w_norm * prob)) if has_data.any() and 'xac_suat' in df.columns
+        else np.nan,
+        'coverage': float(w.sum() / total_w) if total_w > 0 else 0.0,
+        'missing': missing + held.loc[~has_data, 'Mã doanh nghiệp'].tolist(),
+        'by_industry': by_industry.rename('Tỷ trọng').reset_index(),
+        'hhi': hhi,
+        'effective_industries': 1 / hhi if hhi > 0 else np.nan,
+        'yearly': yearly.reset_index(),
+    }
@@ -0,0 +1,118 @@
+"""Đối chiếu các chỉ mục mảng của risk_core / risk_portfolio với cách làm pandas thông thường (lọc + sắp xếp)."""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import risk_core as core  # noqa: E402
+import risk_portfolio as portfolio  # noqa: E402
+
+YEAR_RANGES = [(2015, 2022), (2017, 2019), (2018, 2018), (2010, 2014), (2023, 2030), (2016, 2030)]
+
+
+@pytest.fixture(scope='module')
+def data():
+    """Dữ liệu nhỏ có năm bị khuyết, nhiều kỳ báo cáo trong cùng năm và thứ tự dòng xáo trộn."""
+    rng = np.random.default_rng(7)
+    n = 400
+    df = pd.DataFrame({
+        'Mã doanh nghiệp': rng.choice([f"M{i:02d}" for i in range(30)], n),
+        'Ngành nghề': rng.choice(['Ngân hàng', 'Thép', 'Bán lẻ'], n),
+        'Năm': rng.choice([2015, 2016, 2018, 2019, 2022], n).astype(float),
+        'Ngày báo cáo': pd.Timestamp('2015-01-01') + pd.to_timedelta(rng.integers(0, 3000, n), unit='D'),
+        'Điểm rủi ro': rng.uniform(0, 100, n),
+    })
+    for col in core.PEER_FEATURES:
+        df[col] = rng.normal(size=n)
+    fidx = core.build_filter_index(df)
+    tidx = core.build_ticker_index(df, fidx)
+    return df, fidx, tidx
+
+
+def _sorted(df):
+    return df.sort_values(['Năm', 'Ngày báo cáo'], kind='stable')
+
+
+def _latest_ref(df, ma, year_range=None):
+    sub = df[df['Mã doanh nghiệp'] == ma]
+    if year_range is not None:
+        sub = sub[sub['Năm'].between(*year_range)]
+    return _sorted(sub).index[-1] if len(sub) else -1
+
+
+def test_upto_tables_match_pandas(data):
+    df, fidx, tidx = data
+    y_min, y_max = fidx['year_range']
+    for ma, code in fidx['ma_pos'].items():
+        for year in range(y_min, y_max + 1):
+            sub = _sorted(df[(df['Mã doanh nghiệp'] == ma) & (df['Năm'] <= year)])
+            exp_pos = sub.index[-1] if len(sub) else -1
+            exp_year = int(sub['Năm'].iloc[-1]) if len(sub) else -1
+            assert tidx['upto_pos'][code, year - y_min] == exp_pos
+            assert tidx['upto_year'][code, year - y_min] == exp_year
+
+
+@pytest.mark.parametrize('year_range', [None] + YEAR_RANGES)
+def test_latest_positions_match_pandas(data, year_range):
+    df, fidx, tidx = data
+    expected = [_latest_ref(df, ma, year_range) for ma in fidx['ma_pos']]
+    np.testing.assert_array_equal(core.latest_positions(fidx, tidx, year_range), expected)
+
+
+@pytest.mark.parametrize('year_range', [None] + YEAR_RANGES)
+def test_holding_rows_match_pandas(data, year_range):
+    df, fidx, tidx = data
+    held = ['M07', 'M03', 'M21', 'M11']
+    codes = np.array([fidx['ma_pos'][m] for m in held])
+    expected = []
+    for ma in held:
+        sub = df[df['Mã doanh nghiệp'] == ma]
+        if year_range is not None:
+            sub = sub[sub['Năm'].between(*year_range)]
+        expected.extend(_sorted(sub).index)
+    np.testing.assert_array_equal(portfolio._holding_rows(fidx, tidx, codes, year_range), expected)
+
+
+def test_parse_holdings_semicolon_uses_decimal_comma():
+    raw = "ma_ck;ty_trong\nVNM;0,4\nHPG;1.500.000\nFPT;abc\nVNM;0,1\n".encode('utf-8')
+    holdings = portfolio.parse_holdings(raw, "danh_muc.csv")
+    assert holdings.set_index('Mã doanh nghiệp')['Tỷ trọng'].to_dict() == {'VNM': 0.5, 'HPG': 1_500_000.0}
+    assert holdings.attrs['invalid'] == [('FPT', 'abc')]
+
+
+def test_parse_holdings_comma_keeps_decimal_point():
+    holdings = portfolio.parse_holdings(b"ma_ck,ty_trong\nVNM,0.4\nHPG,0.6\n", "danh_muc.csv")
+    assert holdings.set_index('Mã doanh nghiệp')['Tỷ trọng'].to_dict() == {'VNM': 0.4, 'HPG': 0.6}
+
+
+def _peers_ref(df, pidx, row, k, metric, same_industry, same_year):
+    if metric == 'cosine':
+        score = pidx['unit'] @ pidx['unit'][row]
+    else:
+        score = -np.linalg.norm(pidx['X'].astype(np.float64) - pidx['X'][row], axis=1)
+    cand = df.assign(score=score)
+    cand = cand[cand['Mã doanh nghiệp'] != df.at[row, 'Mã doanh nghiệp']]
+    if same_industry:
+        cand = cand[cand['Ngành nghề'] == df.at[row, 'Ngành nghề']]
+    if same_year:
+        cand = cand[cand['Năm'] == df.at[row, 'Năm']]
+    best = cand.sort_values('score', ascending=False, kind='stable').drop_duplicates('Mã doanh nghiệp')
+    return best.index[:k].to_numpy()
+
+
+@pytest.mark.parametrize('oversample', [core.PEER_OVERSAMPLE, 1])
+@pytest.mark.parametrize('metric', core.PEER_METRICS)
+@pytest.mark.parametrize('same_industry,same_year', [(False, False), (True, False), (False, True)])
+def test_find_peers_one_row_per_ticker(data, monkeypatch, oversample, metric, same_industry, same_year):
+    df, fidx, _ = data
+    # oversample = 1: nhóm ứng viên đầu thiếu mã khác nhau -> phải rơi vào nhánh sắp xếp toàn bộ
+    monkeypatch.setattr(core, 'PEER_OVERSAMPLE', oversample)
+    pidx = core.build_peer_index(df, fidx)
+    for row in (0, 57, 311):
+        got, _ = core.find_peers(pidx, row, k=8, metric=metric, same_industry=same_industry, same_year=same_year)
+        assert df['Mã doanh nghiệp'].iloc[got].is_unique
+        np.testing.assert_array_equal(got, _peers_ref(df, pidx, row, 8, metric, same_industry, same_year))